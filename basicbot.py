@@ -11,7 +11,7 @@
 #
 # note: algorithm improvements are deferred for machine learning, for now just use random
 #
-import os, random
+import os, random, time
 import basicbot_lib as bblib
 from flask import Flask, request, json, make_response
 from flask_restful import Resource, Api
@@ -20,36 +20,63 @@ APP = Flask(__name__)
 API = Api(APP)
 DBGPRINT = APP.logger.debug
 
-@APP.before_request
-def set_random_seed():
-    bblib.set_random_seed()
-
 class Heartbeat(Resource):
     def post(self):
         return { "status": "success", "data": "OK" }
 
+class Metrics(Resource):
+    def get(self):
+        response = make_response(bblib.metrics_text())
+        response.headers['content-type'] = 'text/plain; version=0.0.4'
+        return response
+
 class BasicNextMove(Resource):
     def post(self):
+        # the budget covers decoding the request, too
+        start, started = time.monotonic(), time.perf_counter()
         if request.data:
             jsondata = json.loads(request.data)
+            max_msec = jsondata.get('maxResponseMsec')
             player_id = str(jsondata['botPlayerId'])
             game_info = jsondata['gameInfo']
         else:
+            max_msec = request.form.get('maxResponseMsec')
             player_id = str(request.form['botPlayerId'])
             game_info = json.loads(request.form['gameInfo'])
-        move = bblib.select_next_move(player_id, game_info)
+        deadline = bblib.response_deadline(max_msec, start)
+        bblib.observe_phase('decode', started)
+        # debugging aids (scores, maps, stats) are opt-in: ?debug=1 or X-Bot-Debug: 1
+        debug = DEBUG or '1' in [request.args.get('debug'), request.headers.get('X-Bot-Debug')]
+        # a generator per request: requests can be served concurrently.  retries and
+        # duplicates of a request get the same reply, computed once.  the time budget
+        # is part of the key: form requests only hash gameInfo
+        seed = bblib.DBG_RAND_SEED
+        fingerprint = bblib.request_fingerprint(player_id, game_info, (seed, debug, max_msec),
+                                                request.data or request.form['gameInfo'])
+        move = bblib.coalesced(fingerprint, lambda: bblib.select_next_move(
+            player_id, game_info, rng=bblib.new_rng(seed), deadline=deadline, decorate=debug))
+        encode_start = time.perf_counter()
         if DEBUG:
             DBGPRINT("move response: \n{}".format(bblib.compact_json_dumps(move)))
             response = make_response(bblib.compact_json_dumps(move))
             response.headers['content-type'] = 'application/json'
-        else:
+        elif debug:
             response = move
+        else:
+            response = make_response(bblib.fast_json_dumps(bblib.protocol_move(move)))
+            response.headers['content-type'] = 'application/json'
+        bblib.observe_phase('encode', encode_start)
+        bblib.observe_response(time.perf_counter() - started, game_info.get('game_id'),
+                               game_info.get('map_name', ''))
         return response
 
 API.add_resource(Heartbeat, '/meatshields/bot/getHeartbeat')
 API.add_resource(BasicNextMove, '/meatshields/bot/getNextMove')
+API.add_resource(Metrics, '/meatshields/bot/getMetrics')
 
 DEBUG = (os.environ.get('FLASK_DEBUG', '0') == '1')
 
 if __name__ == '__main__':
+    if bblib.PARALLEL_MOVE_DISCOVERY:
+        bblib.start_worker_pool()   # fork the workers before the server starts threads
     APP.run(debug=DEBUG)
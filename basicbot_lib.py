@@ -12,30 +12,46 @@
 #
 # note: algorithm improvements are deferred for machine learning, for now just use random
 #
-import sys, os, re, copy, datetime, json, time, numpy, random
-from multiprocessing import Process, Manager
+import os, re, copy, time, json, functools, signal, numpy, random
+import multiprocessing, threading, collections, queue, bisect, hashlib
+try:
+    import orjson   # optional: faster responses, see fast_json_dumps()
+except ImportError:
+    orjson = None
 
 DEBUG = (os.environ.get('FLASK_DEBUG', '0') == '1')
 
-# use env vars to turn on verbose debugging -- more control and shuts up pylint
-DBG_MOVEMENT = (os.environ.get('DBG_MOVEMENT', '0') == '1')
-DBG_TIMING = (os.environ.get('DBG_TIMING', '0') == '1')
-DBG_PARSE_TIMING = (os.environ.get('DBG_PARSE_TIMING', '0') == '1')
-DBG_PRINT_SHORTCODES = (os.environ.get('DBG_PRINT_SHORTCODES', '0') == '1')
-DBG_NOTABLE_TILES = (os.environ.get('DBG_NOTABLE_TILES', '0') == '1')
-DBG_MOVES = (os.environ.get('DBG_MOVES', '0') == '1')
+# use env vars to turn on verbose debugging -- more control and shuts up pylint.
+# each DBG_<CATEGORY> flag below is a trace category: checked once here, and
+# TRACE=movement,loading (or TRACE=all) turns categories on by name too.
+TRACE_NAMES = set(os.environ.get('TRACE', '').lower().replace(' ', '').split(','))
+def dbg_flag(name, default='0'):
+    return (os.environ.get(name, default) == '1' or 'all' in TRACE_NAMES or
+            name[len('DBG_'):].lower() in TRACE_NAMES)
+DBG_MOVEMENT = dbg_flag('DBG_MOVEMENT')
+DBG_TIMING = dbg_flag('DBG_TIMING')
+DBG_PARSE_TIMING = dbg_flag('DBG_PARSE_TIMING')
+DBG_PRINT_SHORTCODES = dbg_flag('DBG_PRINT_SHORTCODES')
+DBG_NOTABLE_TILES = dbg_flag('DBG_NOTABLE_TILES')
+DBG_MOVES = dbg_flag('DBG_MOVES')
 DBG_STATS = (os.environ.get('DBG_STATS', '1') == '1')
-DBG_SCORING = (os.environ.get('DBG_SCORING', '0') == '1')
-DBG_SCORING_DETAIL = (os.environ.get('DBG_SCORING_DETAIL', '0') == '1')
-DBG_LOADING = (os.environ.get('DBG_LOADING', '0') == '1')
-DBG_PRINT_DAMAGE_TBL = (os.environ.get('DBG_PRINT_DAMAGE_TBL', '0') == '1')
-DBG_GAME_STATE = (os.environ.get('DBG_GAME_STATE', '0') == '1')
-DBG_ATTACK = (os.environ.get('DBG_ATTACK', '0') == '1')
+DBG_SCORING = dbg_flag('DBG_SCORING')
+DBG_SCORING_DETAIL = dbg_flag('DBG_SCORING_DETAIL')
+DBG_LOADING = dbg_flag('DBG_LOADING')
+DBG_PRINT_DAMAGE_TBL = dbg_flag('DBG_PRINT_DAMAGE_TBL')
+DBG_GAME_STATE = dbg_flag('DBG_GAME_STATE')
+DBG_ATTACK = dbg_flag('DBG_ATTACK')
+# the board as text, on the first move of each turn
+DBG_BOARD = dbg_flag('DBG_BOARD', '1' if DEBUG else '0')
 
 DBG_RAND_SEED = int(os.environ.get('DBG_RAND_SEED', '1337'))
 
 CLIP_POSS_MOVES = int(os.environ.get('CLIP_POSS_MOVES', '50'))
 
+# response time budget, 0 = none.  a request's maxResponseMsec overrides it.  half
+# the budget goes to finding moves, the rest to scoring them (see response_deadline)
+MAX_RESPONSE_MSEC = int(os.environ.get('MAX_RESPONSE_MSEC', '0'))
+
 # pick from the top N moves - avoids herd of mediocre moves - 0 to pick all
 PRUNE_TOP_N_MOVES = int(os.environ.get('PRUNE_TOP_N_MOVES', '6'))
 assert PRUNE_TOP_N_MOVES >= 0
@@ -50,26 +66,361 @@ assert MAX_JOIN_THRESHOLD <= 200 # 200 = always consider joining
 # (leaving this code in because it's simple and might make a difference once
 # the bots are smart enough)
 PARALLEL_MOVE_DISCOVERY = (os.environ.get('PARALLEL_MOVE_DISCOVERY', '0') == '1')
-DBG_PARALLEL_MOVE_DISCOVERY = (os.environ.get('DBG_PARALLEL_MOVE_DISCOVERY', '0') == '1')
+DBG_PARALLEL_MOVE_DISCOVERY = dbg_flag('DBG_PARALLEL_MOVE_DISCOVERY')
+# pool size (0 = one per cpu), and boards with fewer unmoved units+castles run serially
+PARALLEL_WORKERS = int(os.environ.get('PARALLEL_WORKERS', '0'))
+PARALLEL_MIN_TILES = int(os.environ.get('PARALLEL_MIN_TILES', '8'))
+
+# keep each game's parsed board between requests, re-parsing only the changed tiles
+SESSION_CACHE = (os.environ.get('SESSION_CACHE', '1') == '1')
+
+# plan the whole turn on its first move, and answer the rest of the turn from the plan
+PLAN_TURNS = (os.environ.get('PLAN_TURNS', '0') == '1')
+
+# per-game state (GAMES, LAST_MOVES) is evicted least recently used first, once
+# there are too many games or their estimated size is too big, and after a game
+# hasn't been seen for the TTL
+GAME_STORE_MAX_GAMES = int(os.environ.get('GAME_STORE_MAX_GAMES', '1000'))
+GAME_STORE_MAX_MB = int(os.environ.get('GAME_STORE_MAX_MB', '1024'))
+GAME_STORE_TTL_SEC = int(os.environ.get('GAME_STORE_TTL_SEC', '3600'))
+
+# replies to repeated requests (same game, player, board and seed) are cached
+# this long, for this many requests; RESPONSE_CACHE_SIZE=0 turns this off
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '1000'))
+RESPONSE_CACHE_TTL_SEC = int(os.environ.get('RESPONSE_CACHE_TTL_SEC', '600'))
+
+# with FLASK_DEBUG, requests are saved to game-<game_id>.json for replay, at most
+# once per game per interval, by a background thread
+DEBUG_DUMP_INTERVAL_SEC = float(os.environ.get('DEBUG_DUMP_INTERVAL_SEC', '5'))
+
+# terrain-only per-map data (see map_template) is kept in memory, and with
+# MAP_CACHE_DIR also saved there for other processes to memory-map
+MAP_TEMPLATE_CACHE = (os.environ.get('MAP_TEMPLATE_CACHE', '1') == '1')
+MAP_CACHE_DIR = os.environ.get('MAP_CACHE_DIR', '')
+
+# responses slower than this are counted per map and logged with their game_id
+METRICS_SLO_MSEC = int(os.environ.get('METRICS_SLO_MSEC', '1000'))
 
 APP = API = None
 
+class GameOver(Exception):
+    """the game is won: there's nothing left to capture (see score_move)."""
+
 ATTACK_DEFENDER_KILLED = -1
 ATTACK_ATTACKER_KILLED = -2
 
+#---------------------------------------------------------------------------
+# bounded per-game storage: servers are long-running, and games end without
+# telling us.
+#
+
+class BoundedStore(object):
+    """thread-safe dict with LRU and TTL eviction.  max_bytes is checked against
+    sizeof(value), which is only called on put(): put() a value again after
+    growing it.  counts hits, misses and evictions (see stats())."""
+    def __init__(self, max_entries, ttl_sec=0, max_bytes=0, sizeof=None):
+        self.max_entries, self.ttl_sec, self.max_bytes = max_entries, ttl_sec, max_bytes
+        self.sizeof = sizeof or (lambda val: 0)
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()   # key => [value, last use, bytes]
+        self.num_bytes = 0
+        self.counts = collections.Counter()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.expired(entry, time.monotonic()):
+                self.evict(key, 'ttl')
+                entry = None
+            if entry is None:
+                self.counts['misses'] += 1
+                return default
+            self.counts['hits'] += 1
+            entry[1] = time.monotonic()
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, val):
+        num_bytes = self.sizeof(val)
+        with self.lock:
+            now = time.monotonic()
+            if key in self.entries:
+                self.num_bytes -= self.entries.pop(key)[2]
+            self.entries[key] = [val, now, num_bytes]
+            self.num_bytes += num_bytes
+            # oldest first, never the entry just put
+            while len(self.entries) > 1:
+                oldest_key, oldest = next(iter(self.entries.items()))
+                if self.expired(oldest, now):
+                    self.evict(oldest_key, 'ttl')
+                elif len(self.entries) > self.max_entries:
+                    self.evict(oldest_key, 'lru')
+                elif self.max_bytes > 0 and self.num_bytes > self.max_bytes:
+                    self.evict(oldest_key, 'size')
+                else:
+                    break
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+            self.num_bytes -= entry[2]
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def expired(self, entry, now):
+        return self.ttl_sec > 0 and now - entry[1] > self.ttl_sec
+
+    def evict(self, key, reason):
+        self.num_bytes -= self.entries.pop(key)[2]
+        self.counts['evictions_' + reason] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, entries=len(self.entries), bytes=self.num_bytes)
+
+# rough sizes, measured on example_2p_Ancient2-1.json: a session's parsed tiles plus
+# the raw copies, and one plan step's board_fingerprint
+SESSION_BYTES_PER_TILE = 3500
+PLAN_STEP_BYTES_PER_TILE = 250
+
+def estimated_game_bytes(game):
+    session, plan = game.get('session'), game.get('plan')
+    num_bytes = 0
+    if session is not None:
+        num_bytes += SESSION_BYTES_PER_TILE * len(session.raw_tiles)
+    if plan is not None:
+        num_bytes += PLAN_STEP_BYTES_PER_TILE * sum(
+            len(step[0][1]) for step in plan['steps'])
+    return num_bytes
+
 # remember turns and moves between API calls - helps debugging
-GAMES = {}
-LAST_MOVES = {}
+GAMES = BoundedStore(GAME_STORE_MAX_GAMES, GAME_STORE_TTL_SEC, GAME_STORE_MAX_MB << 20,
+                     estimated_game_bytes)
+# only what is_first_move_in_turn needs, i.e. the move's data
+LAST_MOVES = BoundedStore(GAME_STORE_MAX_GAMES, GAME_STORE_TTL_SEC)
+
+#---------------------------------------------------------------------------
+# metrics, in prometheus text format (see metrics_text): timers use
+# time.perf_counter, and observing is a bisect plus an add under a lock.
+#
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0]
+COUNT_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+class Metric(object):
+    """one metric family: a counter, or a histogram if given buckets.  values are
+    kept per tuple of label values, in label_names order."""
+    def __init__(self, name, help_text, label_names=(), buckets=None):
+        self.name, self.help_text, self.label_names = name, help_text, list(label_names)
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}   # label values => total, or [bucket counts..., count, sum]
+        METRICS.append(self)
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def observe(self, value, labels=()):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.series.get(labels)
+            if counts is None:
+                counts = self.series[labels] = [0] * (len(self.buckets) + 2)
+            if idx < len(self.buckets):
+                counts[idx] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self):
+        kind = 'counter' if self.buckets is None else 'histogram'
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} {}'.format(self.name, kind)]
+        with self.lock:
+            series = sorted((labels, copy.copy(val)) for labels, val in self.series.items())
+        for labels, val in series:
+            pairs = ['{}="{}"'.format(name, str(labval).replace('"', "'"))
+                     for name, labval in zip(self.label_names, labels)]
+            if self.buckets is None:
+                lines.append('{}{} {}'.format(self.name, metric_labels(pairs), val))
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets, val):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, metric_labels(pairs + ['le="{}"'.format(bound)]), cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                self.name, metric_labels(pairs + ['le="+Inf"']), val[-2]))
+            lines.append('{}_count{} {}'.format(self.name, metric_labels(pairs), val[-2]))
+            lines.append('{}_sum{} {}'.format(self.name, metric_labels(pairs), val[-1]))
+        return lines
+
+def metric_labels(pairs):
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+METRICS = []
+PHASE_SECONDS = Metric('bot_phase_seconds', 'time spent per request phase', ['phase'],
+                       LATENCY_BUCKETS)
+RESPONSE_SECONDS = Metric('bot_response_seconds', 'getNextMove time, decode to encode',
+                          ['map'], LATENCY_BUCKETS)
+SLO_BREACHES = Metric('bot_slo_breaches_total',
+                      'getNextMove responses slower than METRICS_SLO_MSEC', ['map'])
+CANDIDATE_MOVES = Metric('bot_candidate_moves', 'moves found and scored per choice',
+                         ['stage'], COUNT_BUCKETS)
+POOL_BUSY_SECONDS = Metric('bot_pool_busy_seconds_total',
+                           'time the parallel move discovery workers spent on tasks')
+POOL_CAPACITY_SECONDS = Metric('bot_pool_capacity_seconds_total',
+                               'wall time of parallel move discovery times the pool size')
+
+def observe_phase(phase, start):
+    """records the time since start (a perf_counter value); returns now."""
+    now = time.perf_counter()
+    PHASE_SECONDS.observe(now - start, (phase,))
+    return now
+
+def observe_response(seconds, game_id, map_name):
+    RESPONSE_SECONDS.observe(seconds, (map_name,))
+    if seconds * 1000 > METRICS_SLO_MSEC:
+        SLO_BREACHES.inc(labels=(map_name,))
+        DBGPRINT('slow response: {}ms for game {} on map {}'.format(
+            int(seconds * 1000), game_id, map_name))
+
+def metrics_text():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for store_name, store in [('games', GAMES), ('last_moves', LAST_MOVES),
+                              ('responses', RESPONSES), ('map_templates', MAP_TEMPLATES)]:
+        for stat, val in sorted(store.stats().items()):
+            lines.append('bot_store_{}{{store="{}"}} {}'.format(stat, store_name, val))
+    return "\n".join(lines) + "\n"
+
+#---------------------------------------------------------------------------
+# DEBUG request dumps: the request thread only takes a compact snapshot, at most
+# once per game per DEBUG_DUMP_INTERVAL_SEC.  a daemon thread pretty-prints and
+# writes it; if it falls behind, dumps are dropped rather than queued without end.
+#
+
+DUMP_QUEUE = queue.Queue(maxsize=64)
+DUMP_TIMES = BoundedStore(GAME_STORE_MAX_GAMES)   # game_id => time of last dump
+DUMP_THREAD = None
+DUMP_LOCK = threading.Lock()
+
+def dump_writer():
+    while True:
+        game_id, snapshot = DUMP_QUEUE.get()
+        jsondata = json.loads(snapshot)
+        try:
+            with open('game-{}.json'.format(game_id), 'w') as game_fh:
+                game_fh.write('{} "botPlayerId": {}, "gameInfo": {} {}'.format(
+                    "{", jsondata['botPlayerId'],
+                    json.dumps(jsondata['gameInfo'], indent=2, sort_keys=True), "}"))
+        except OSError as exc:
+            DBGPRINT('failed to save game {}: {}'.format(game_id, exc))
+
+def dump_request(game_id, player_id, game_info):
+    """saves the request to game-<game_id>.json for replay, in the background."""
+    global DUMP_THREAD
+    now = time.monotonic()
+    last_dump = DUMP_TIMES.get(game_id)
+    if last_dump is not None and now - last_dump < DEBUG_DUMP_INTERVAL_SEC:
+        return
+    DUMP_TIMES.put(game_id, now)
+    with DUMP_LOCK:
+        if DUMP_THREAD is None:
+            DUMP_THREAD = threading.Thread(target=dump_writer, name='dump_writer', daemon=True)
+            DUMP_THREAD.start()
+    try:
+        DUMP_QUEUE.put_nowait((game_id, json.dumps(
+            {'botPlayerId': player_id, 'gameInfo': game_info})))
+    except queue.Full:
+        DBGPRINT('dump queue full: not saving game {}'.format(game_id))
+
+#---------------------------------------------------------------------------
+# duplicate requests: the game server retries after a timeout, and sometimes asks
+# twice about the same board.  replies are cached by request_fingerprint(), and
+# a duplicate that arrives while the first is still being computed waits for it
+# instead of computing it again.
+#
+
+RESPONSES = BoundedStore(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SEC)   # fingerprint => move
+IN_FLIGHT = {}   # fingerprint => threading.Event, set when its move is in RESPONSES
+IN_FLIGHT_LOCK = threading.Lock()
+DUPLICATE_REQUESTS = Metric('bot_duplicate_requests_total',
+                            'requests answered from the response cache', ['source'])
+
+def request_fingerprint(player_id, game_info, seed, raw=None):
+    """identifies a request: game_id, player, the board and everything else in
+    game_info, and seed (plus whatever else changes the reply, e.g. debug mode).
+    raw is the request body as received, if any: hashing it saves re-encoding."""
+    sha = hashlib.sha1(repr((game_info.get('game_id'), player_id, seed)).encode('utf-8'))
+    if raw is None:
+        raw = fast_json_dumps(game_info)
+    sha.update(raw.encode('utf-8') if isinstance(raw, str) else raw)
+    return sha.hexdigest()
+
+def coalesced(fingerprint, compute_move):
+    """compute_move(), unless fingerprint's move was already computed, or is being
+    computed by another thread: then that move (a copy of it)."""
+    if RESPONSE_CACHE_SIZE <= 0:
+        return compute_move()
+    waited = False
+    while True:
+        # looked up under the lock: the request computing this move stores it before
+        # it leaves IN_FLIGHT, so a move that isn't in either is really not computed
+        with IN_FLIGHT_LOCK:
+            move = RESPONSES.get(fingerprint)
+            event = IN_FLIGHT.get(fingerprint)
+            if move is None and event is None:
+                IN_FLIGHT[fingerprint] = threading.Event()
+        if move is not None:
+            DUPLICATE_REQUESTS.inc(labels=('in_flight' if waited else 'cache',))
+            return copy.deepcopy(move)
+        if event is None:
+            break
+        # if the other request fails, its move never arrives: then compute our own
+        event.wait()
+        waited = True
+    try:
+        move = compute_move()
+        RESPONSES.put(fingerprint, copy.deepcopy(move))
+        return move
+    finally:
+        with IN_FLIGHT_LOCK:
+            IN_FLIGHT.pop(fingerprint).set()
 
 def dbgprint(msg):
     print(msg)
 
 DBGPRINT = dbgprint
 
+def trace(enabled, fmt, *args):
+    """DBGPRINT(fmt.format(*args)) if enabled, a DBG_* flag.  nothing is formatted
+    when disabled, and callable args are only called when enabled, so pass expensive
+    ones unevaluated, e.g. functools.partial(tilestr, unit).  a disabled trace() is
+    still a call: in hot loops, test the flag instead."""
+    if enabled:
+        DBGPRINT(fmt.format(*[arg() if callable(arg) else arg for arg in args]))
+
 def set_random_seed():
     """reproducibility.  set DBG_RAND_SEED to force, e.g. for true randomness"""
     random.seed(DBG_RAND_SEED)
     numpy.random.seed(DBG_RAND_SEED)
+
+def new_rng(seed=None):
+    """a private generator for one request, seeded like set_random_seed(), so
+    concurrent games don't share (or reseed) the global numpy.random state."""
+    return numpy.random.RandomState(DBG_RAND_SEED if seed is None else seed)
     
 def mkres(**args):
     """ e.g. mkres(move={"x_coordinates": ... }) """
@@ -177,12 +528,6 @@ def setup_damage_table():
 
 setup_damage_table()
 
-MY_HQ, OTHER_HQ = None, []
-MY_UNITS, ENEMY_UNITS = [], []
-MY_CASTLES, OTHER_CASTLES = [], []
-MY_TOWNS, OTHER_TOWNS = [], []
-TILES_BY_IDX = {}
-
 TILE_DEFAULT_VALUES = dict([(tdv_fld,None) for tdv_fld in re.split(r'[ ,\r\n]+', """
   building_army_id, building_army_name, building_team_name, capture_remaining, 
   deployed_unit_id, primary_ammo, secondary_ammo, unit_id, unit_name, unit_team_name
@@ -220,6 +565,22 @@ def unit_health(unit):
     health = unit.get('health', 100)
     return 100 if health is None else int(health)
 
+def protocol_move(move):
+    """move without its __ decorations (scores, maps, stats, ...), at any depth,
+    i.e. only what the game server reads."""
+    if isinstance(move, dict):
+        return dict((key, protocol_move(val)) for key, val in move.items()
+                    if not key.startswith('__'))
+    if isinstance(move, list):
+        return [protocol_move(val) for val in move]
+    return move
+
+def fast_json_dumps(data):
+    """compact JSON, as bytes.  uses orjson if installed."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
 def compact_json_dumps(data):
     compact_response = json.dumps(data, indent=2, sort_keys=True)
     
@@ -335,9 +696,9 @@ def xy_nbrs(xyidx):
     # north/south aka y +/- 1000, east/west aka x +/- 1
     return [xyidx+1000, xyidx-1000, xyidx+1, xyidx-1]
     
-def immed_nbrs(tile):
+def immed_nbrs(tile, tiles_by_idx):
     """simple adjacency excluding tiles that are off the map."""
-    return [nbr for nbr in [TILES_BY_IDX.get(xy) for xy in xy_nbrs(tile['xyidx'])]
+    return [nbr for nbr in [tiles_by_idx.get(xy) for xy in xy_nbrs(tile['xyidx'])]
             if nbr is not None]
 
 def walk_cost(unit_type, terrain):
@@ -356,45 +717,6 @@ def walk_cost(unit_type, terrain):
     # impassable
     return 0
 
-def walkable_tiles(tile, army_id, unit_tile, cost_remaining, path):
-    unit_type, terrain = unit_tile['unit_name'], tile['terrain_name']
-    walkcost = walk_cost(unit_type, terrain)
-    # impassable by this unit type, or beyond the range
-    if walkcost == 0 or cost_remaining < walkcost: return []
-    tile['seen'] = cost_remaining
-    tile['path'] = path   # path to get to this tile
-    dest_tiles = [tile]
-    if DBG_MOVEMENT:
-        DBGPRINT(('walkable_tiles(tile={}, unit_tile={}, walkcost={}, '+
-                          'cost_remaining={}, path={}, typ={}, terr={}'
-        ).format(tilestr(tile), tilestr(unit_tile), walkcost, cost_remaining,
-                 pathstr(path), unit_type, terrain))
-    immediate_neighbors = [nbr for nbr in immed_nbrs(tile) if
-                           # revisit tiles only if there's greater walking range left
-                           cost_remaining > nbr.get('seen', 0) and
-                           # walk over friends but not enemies
-                           nbr.get('unit_army_id') in [None, army_id]]
-    if DBG_MOVEMENT:
-        DBGPRINT('immediate neighbors of {}: {}, path:{}, moves left:{}'.format(
-            tilestr(tile), pathstr(immediate_neighbors), pathstr(path),
-            cost_remaining - walkcost))
-    newpath = path + ([] if tile['xy'] == unit_tile['xy'] else [tile])
-    for immediate_neighbor in immediate_neighbors:
-        destinations = walkable_tiles(immediate_neighbor, army_id, unit_tile,
-                                      cost_remaining - walkcost, newpath)
-        msgs = ['neighbors of {}, newpath={}, destinations:'.format(
-            tilestr(immediate_neighbor), pathstr(newpath))]
-        for nbr in destinations:
-            if nbr['path'] is None:
-                nbr['path'] = newpath
-            dest_tiles.append(nbr)
-            msgs.append('{}: {}'.format(tilestr(nbr), pathstr(nbr['path'])))
-        if DBG_MOVEMENT:
-            DBGPRINT('\n'.join(msgs))
-    if DBG_MOVEMENT:
-        DBGPRINT('dest_tiles: {}'.format(";".join([tilestr(til) for til in dest_tiles])))
-    return dest_tiles
-
 def dist(unit, tile):
     """euclidean distance - used for missile attacks and a (bad) approximation of travel time."""
     return abs(tile['x'] - unit['x']) + abs(tile['y'] - unit['y'])
@@ -546,33 +868,33 @@ def set_xy_fields(tile):
     tile['xystr'], tile['xyidx'] = tile2xystr(tile), tile2xyidx(tile)
     return tile
 
-def parse_tiles_by_idx(army_id, tiles_by_idx):
-    global MY_HQ, OTHER_HQ, MY_UNITS, ENEMY_UNITS, MY_CASTLES
-    global OTHER_CASTLES, MY_TOWNS, OTHER_TOWNS
-    MY_HQ, OTHER_HQ = None, []
-    MY_UNITS, ENEMY_UNITS = [], []
-    MY_CASTLES, OTHER_CASTLES = [], []
-    MY_TOWNS, OTHER_TOWNS = [], []
-    tiles, notable_tiles = list(tiles_by_idx.values()), []
+def parse_tiles_by_idx(state):
+    """(re)builds state's unit and building lists from state.tiles_by_idx."""
+    army_id = state.army_id
+    state.my_hq, state.other_hq = None, []
+    state.my_units, state.enemy_units = [], []
+    state.my_castles, state.other_castles = [], []
+    state.my_towns, state.other_towns = [], []
+    tiles, notable_tiles = list(state.tiles_by_idx.values()), []
     for tile in tiles:
         # unit_name will be absent if unit is killed...
         if tile.get('unit_name') is not None and tile['unit_army_id'] not in ["", None]:
-            units_list = MY_UNITS if tile['unit_army_id'] == army_id else ENEMY_UNITS
+            units_list = state.my_units if tile['unit_army_id'] == army_id else state.enemy_units
             units_list.append(tile)
             tile['unit_type'] = UNIT_TYPES[tile['unit_name']]
             notable_tiles.append(tile)
         if tile['terrain_name'] == 'Headquarters':
             if is_my_building(tile, army_id):
-                MY_HQ = tile
+                state.my_hq = tile
             else:
-                OTHER_HQ.append(tile)
+                state.other_hq.append(tile)
             notable_tiles.append(tile)
         elif tile['terrain_name'] == 'Castle':
-            castle_list = MY_CASTLES if is_my_building(tile, army_id) else OTHER_CASTLES
+            castle_list = state.my_castles if is_my_building(tile, army_id) else state.other_castles
             castle_list.append(tile)
             notable_tiles.append(tile)
         elif tile['terrain_name'] == 'Town':
-            town_list = MY_TOWNS if is_my_building(tile, army_id) else OTHER_TOWNS
+            town_list = state.my_towns if is_my_building(tile, army_id) else state.other_towns
             town_list.append(tile)
     if DBG_NOTABLE_TILES:
         DBGPRINT("notable_tiles:  my army_id={}\n{}".format(
@@ -580,23 +902,10 @@ def parse_tiles_by_idx(army_id, tiles_by_idx):
                                 for tile in sorted_tiles(notable_tiles)])))
     
 def parse_map(army_id, tiles, game_info):
-    TILES_BY_IDX.clear()
-    next_tile_id = 1000
+    """returns the GameState for army_id."""
+    tiles_by_idx = {}
     if '__tilemap' in game_info:
-        for ypos, row in enumerate(game_info['__tilemap']):
-            for xpos, char in enumerate(row):
-                tile = set_xy_fields({
-                    'in_fog': ("1" if char in LOWER_SHORTCODES_TERRAIN else "0"),
-                    'terrain_name': UPPER_SHORTCODES_TERRAIN[char.upper()],
-                    'x_coordinate': str(xpos), 'y_coordinate': str(ypos)
-                })
-                tile.update(dict((fld,val) for fld, val in TILE_DEFAULT_VALUES.items()
-                                 if fld not in tile))
-                tile['defense'] = TERRAIN_DEFENSE[tile['terrain_name']]
-                tile['tile_id'] = next_tile_id
-                next_tile_id += 1
-                TILES_BY_IDX[tile['xyidx']] = tile
-                #DBGPRINT('{}: {}'.format(tile['xy'], tile))
+        tiles_by_idx = tilemap_tiles(game_info['__tilemap'])
     # old style, including army details
     in_comment = False
     for tile_ar in tiles:
@@ -609,17 +918,553 @@ def parse_map(army_id, tiles, game_info):
             if in_comment or tile.get('__comment') is not None: continue
             tile = set_xy_fields(tile)
             if '__tilemap' in game_info:
-                if tile['xyidx'] not in TILES_BY_IDX:
+                if tile['xyidx'] not in tiles_by_idx:
                     raise Exception("bad tile index {} - tilemap doesn't match JSON?".format(
                         tile['xyidx']))
-                TILES_BY_IDX[tile['xyidx']].update(tile)
+                tiles_by_idx[tile['xyidx']].update(tile)
             else:
-                TILES_BY_IDX[tile['xyidx']] = tile
-    parse_tiles_by_idx(army_id, TILES_BY_IDX)
-    return TILES_BY_IDX
+                tiles_by_idx[tile['xyidx']] = tile
+    template = None
+    if MAP_TEMPLATE_CACHE:
+        template = map_template(game_info.get('map_name', ''), tiles_by_idx)
+    return GameState(army_id, tiles_by_idx, template=template)
+
+def decode_tilemap(tilemap):
+    """tiles_by_idx for the terrain in tilemap's rows, with default values."""
+    tiles_by_idx = {}
+    next_tile_id = 1000
+    for ypos, row in enumerate(tilemap):
+        for xpos, char in enumerate(row):
+            tile = set_xy_fields({
+                'in_fog': ("1" if char in LOWER_SHORTCODES_TERRAIN else "0"),
+                'terrain_name': UPPER_SHORTCODES_TERRAIN[char.upper()],
+                'x_coordinate': str(xpos), 'y_coordinate': str(ypos)
+            })
+            tile.update(dict((fld,val) for fld, val in TILE_DEFAULT_VALUES.items()
+                             if fld not in tile))
+            tile['defense'] = TERRAIN_DEFENSE[tile['terrain_name']]
+            tile['tile_id'] = next_tile_id
+            next_tile_id += 1
+            tiles_by_idx[tile['xyidx']] = tile
+    return tiles_by_idx
+
+def tilemap_tiles(tilemap):
+    """decode_tilemap(tilemap), decoding each map once: the fog-free decode is
+    cached, and each call gets copies of its tiles with in_fog set."""
+    key = tuple([row.upper() for row in tilemap])
+    base_tiles = TILEMAP_TILES.get(key) if MAP_TEMPLATE_CACHE else None
+    if base_tiles is None:
+        base_tiles = decode_tilemap(key)
+        if MAP_TEMPLATE_CACHE:
+            TILEMAP_TILES.put(key, base_tiles)
+    tiles_by_idx = {}
+    chars = [char for row in tilemap for char in row]
+    for (xyidx, base_tile), char in zip(base_tiles.items(), chars):
+        tile = dict(base_tile)
+        tile['in_fog'] = "1" if char in LOWER_SHORTCODES_TERRAIN else "0"
+        tiles_by_idx[xyidx] = tile
+    return tiles_by_idx
+
+class GameState(object):
+    """one board as seen by one army: the tiles plus everything parsed or precomputed
+    from them.  lib functions take it explicitly, so a process can hold any number of
+    games.  the unit and building lists are rebuilt by parse_tiles_by_idx()."""
+    def __init__(self, army_id, tiles_by_idx, move_grid=None, vision_grid=None,
+                 template=None):
+        self.army_id, self.tiles_by_idx, self.template = army_id, tiles_by_idx, template
+        if template is not None:
+            self.board = template.board(tiles_by_idx)
+            move_grid, vision_grid = template.move_grid, template.vision_grid
+        else:
+            self.board = ArrayBoard.from_tiles_by_idx(tiles_by_idx)
+        # terrain-only, so they can be shared by every state on the same map
+        self.move_grid = move_grid or MoveGrid(self.board)
+        self.vision_grid = vision_grid or VisionGrid(self.board)
+        parse_tiles_by_idx(self)
+
+    def view(self, army_id, tiles_by_idx):
+        """a GameState for other tiles on the same map, e.g. a copy or another army."""
+        return GameState(army_id, tiles_by_idx, self.move_grid, self.vision_grid,
+                         self.template)
+
+
+#---------------------------------------------------------------------------
+# array-backed board: integer-coded numpy planes, one (height, width) array per
+# tile attribute.  the dict-of-dicts tiles_by_idx stays the protocol/JSON form;
+# ArrayBoard is built from it at parse time for the vectorized paths.
+#
+
+# code 0 is reserved for "nothing here" in every plane
+TERRAIN_NAMES = [None] + list(TERRAIN_DEFENSE.keys())
+TERRAIN_CODES = dict([(name, code) for code, name in enumerate(TERRAIN_NAMES)])
+UNIT_NAMES = [None] + list(UNIT_TYPES.keys())
+UNIT_CODES = dict([(name, code) for code, name in enumerate(UNIT_NAMES)])
+UNIT_CODES[''] = 0
+
+BOARD_PLANES = ['terrain', 'bldg_owner', 'unit_type', 'unit_army', 'health', 'moved',
+                'capture_remaining', 'cargo', 'cargo_health', 'in_fog']
+BOARD_PLANE_IDX = dict([(name, idx) for idx, name in enumerate(BOARD_PLANES)])
+
+def has_army_unit(tile):
+    """same test parse_tiles_by_idx uses: a unit_name plus a non-empty army."""
+    return tile.get('unit_name') is not None and tile.get('unit_army_id') not in ["", None]
+
+class ArrayBoard(object):
+    """all planes live in one int16 array, so copy() is a single memcpy.
+    planes are exposed as views, e.g. board.unit_army[y, x]."""
+    def __init__(self, width, height, planes=None):
+        self.width, self.height = width, height
+        if planes is None:
+            planes = numpy.zeros((len(BOARD_PLANES), height, width), numpy.int16)
+        self.planes = planes
+        for name, idx in BOARD_PLANE_IDX.items():
+            setattr(self, name, planes[idx])
+
+    @classmethod
+    def from_tiles_by_idx(cls, tiles_by_idx):
+        width = max([tile['x'] for tile in tiles_by_idx.values()]) + 1
+        height = max([tile['y'] for tile in tiles_by_idx.values()]) + 1
+        board = cls(width, height)
+        for tile in tiles_by_idx.values():
+            board.update_tile(tile)
+        return board
+
+    def copy(self):
+        return ArrayBoard(self.width, self.height, self.planes.copy())
+
+    def __reduce__(self):
+        # pickle the one array: pickled plane attributes would stop being views of it
+        return (ArrayBoard, (self.width, self.height, self.planes))
+
+    def update_tile(self, tile):
+        """re-encode one tile dict, e.g. after apply_move touched it."""
+        xpos, ypos = tile['x'], tile['y']
+        self.terrain[ypos, xpos] = TERRAIN_CODES[tile['terrain_name']]
+        self.bldg_owner[ypos, xpos] = bldg_army_id(tile)
+        self.capture_remaining[ypos, xpos] = get_capture_remaining(tile)
+        self.in_fog[ypos, xpos] = (tile.get('in_fog') == '1')
+        if has_army_unit(tile):
+            self.unit_type[ypos, xpos] = UNIT_CODES[tile['unit_name']]
+            self.unit_army[ypos, xpos] = int(tile['unit_army_id'])
+            self.health[ypos, xpos] = unit_health(tile)
+            self.moved[ypos, xpos] = (str(tile.get('moved')) == '1')
+            self.cargo[ypos, xpos] = UNIT_CODES[tile.get('slot1_deployed_unit_name')]
+            self.cargo_health[ypos, xpos] = int(
+                ifdictnone(tile, 'slot1_deployed_unit_health', 0) or 0)
+        else:
+            for plane in ['unit_type', 'unit_army', 'health', 'moved', 'cargo', 'cargo_health']:
+                self.planes[BOARD_PLANE_IDX[plane], ypos, xpos] = 0
+
+    def unit_mask(self, army_id):
+        return self.unit_army == int(army_id)
+
+    def tile_fields(self, xpos, ypos):
+        """inverse of update_tile, in protocol (string-valued) form."""
+        res = {
+            'x_coordinate': str(xpos), 'y_coordinate': str(ypos),
+            'terrain_name': TERRAIN_NAMES[self.terrain[ypos, xpos]],
+            'in_fog': "1" if self.in_fog[ypos, xpos] else "0",
+        }
+        owner = int(self.bldg_owner[ypos, xpos])
+        if owner != 0:
+            res['building_army_id'] = str(owner)
+        if res['terrain_name'] in CAPTURABLE_TERRAIN:
+            res['capture_remaining'] = str(self.capture_remaining[ypos, xpos])
+        unit_code = int(self.unit_type[ypos, xpos])
+        if unit_code != 0:
+            res.update({
+                'unit_name': UNIT_NAMES[unit_code],
+                'unit_army_id': str(self.unit_army[ypos, xpos]),
+                'health': str(self.health[ypos, xpos]),
+                'moved': str(self.moved[ypos, xpos]) })
+            cargo_code = int(self.cargo[ypos, xpos])
+            if cargo_code != 0:
+                res['slot1_deployed_unit_name'] = UNIT_NAMES[cargo_code]
+                res['slot1_deployed_unit_health'] = str(self.cargo_health[ypos, xpos])
+        return res
+
+def board_tiles_by_idx(board):
+    """ArrayBoard => tiles_by_idx-style dict, e.g. for compressed_game_info."""
+    tiles_by_idx = {}
+    for ypos in range(board.height):
+        for xpos in range(board.width):
+            tile = set_xy_fields(board.tile_fields(xpos, ypos))
+            tile['defense'] = TERRAIN_DEFENSE[tile['terrain_name']]
+            tiles_by_idx[tile['xyidx']] = tile
+    return tiles_by_idx
+
+#---------------------------------------------------------------------------
+# combat tables: DAMAGE_TBL, TERRAIN_DEFENSE and RETURNS_FIRE_UNITS as arrays indexed
+# by UNIT_CODES/TERRAIN_CODES, so a whole batch of attacks resolves in one pass.
+# the arithmetic follows compute_damage and apply_move step for step, so the
+# results are bit-for-bit the same as the one-at-a-time versions.
+#
+
+DAMAGE_ARR = numpy.zeros((len(UNIT_NAMES), len(UNIT_NAMES)), numpy.int64)
+for dmg_atk, dmg_row in DAMAGE_TBL.items():
+    for dmg_def, dmg_val in dmg_row.items():
+        DAMAGE_ARR[UNIT_CODES[dmg_atk], UNIT_CODES[dmg_def]] = dmg_val
+TERRAIN_DEFENSE_ARR = numpy.array(
+    [0] + [TERRAIN_DEFENSE[terrain] for terrain in TERRAIN_NAMES[1:]], numpy.int64)
+RETURNS_FIRE_ARR = numpy.array([name in RETURNS_FIRE_UNITS for name in UNIT_NAMES])
+
+def compute_damage_batch(atk_type, atk_health, def_type, def_terrain):
+    """compute_damage for arrays of unit codes, healths and terrain codes."""
+    attack_weight = atk_health / 100.0
+    base_damage = DAMAGE_ARR[atk_type, def_type]
+    terrain_weight = 1.0 - (TERRAIN_DEFENSE_ARR[def_terrain] / 10.0)
+    return numpy.maximum(1, (base_damage * attack_weight * terrain_weight).astype(numpy.int64))
+
+def resolve_attacks(atk_type, atk_health, atk_terrain, def_type, def_health, def_terrain):
+    """the attack outcome of apply_move for arrays of attacker/defender codes, healths
+    and terrain (attacker on its attack-from tile).  returns arrays (damage,
+    return_damage, defender health, attacker health) where return_damage is 0 if the
+    defender doesn't fire back, else ATTACK_DEFENDER_KILLED, ATTACK_ATTACKER_KILLED
+    or the damage taken.  like apply_move, the attacker is left with the defender's
+    remaining health minus the return damage."""
+    damage = compute_damage_batch(atk_type, atk_health, def_type, def_terrain)
+    def_left = def_health - damage
+    def_killed = (def_left <= 0)
+    fires_back = ~def_killed & RETURNS_FIRE_ARR[def_type]
+    rdamage = compute_damage_batch(def_type, def_left, atk_type, atk_terrain)
+    atk_left = numpy.where(fires_back, def_left - rdamage, atk_health)
+    return_damage = numpy.where(def_killed, ATTACK_DEFENDER_KILLED, numpy.where(
+        fires_back, numpy.where(atk_left <= 0, ATTACK_ATTACKER_KILLED, rdamage), 0))
+    return damage, return_damage, def_left, atk_left
+
+def resolve_attack_moves(tiles_by_idx, moves):
+    """{mvkey: (damage, return_damage)} for every attack in moves (see cache_move),
+    resolved against tiles_by_idx in one resolve_attacks() call."""
+    mvkeys, atk_tiles, dest_tiles, def_tiles = [], [], [], []
+    for mvkey, move in moves.items():
+        movemove = move.get('data', {}).get('move')
+        if not movemove or 'x_coord_attack' not in movemove: continue
+        mvkeys.append(mvkey)
+        atk_tiles.append(tiles_by_idx[movedict_xyidx(movemove)])
+        dest_tiles.append(tiles_by_idx[movedict_xyidx(movemove['movements'][-1])]
+                          if len(movemove['movements']) > 0 else atk_tiles[-1])
+        def_tiles.append(tiles_by_idx[
+            int(movemove['y_coord_attack'])*1000 + int(movemove['x_coord_attack'])])
+    if len(mvkeys) == 0:
+        return {}
+    def codes(tiles, fld, code_dict):
+        return numpy.array([code_dict[tile[fld]] for tile in tiles], numpy.int64)
+    def healths(tiles):
+        return numpy.array([unit_health(tile) for tile in tiles], numpy.int64)
+    damage, return_damage, _, _ = resolve_attacks(
+        codes(atk_tiles, 'unit_name', UNIT_CODES), healths(atk_tiles),
+        codes(dest_tiles, 'terrain_name', TERRAIN_CODES),
+        codes(def_tiles, 'unit_name', UNIT_CODES), healths(def_tiles),
+        codes(def_tiles, 'terrain_name', TERRAIN_CODES))
+    return dict(zip(mvkeys, zip(damage.tolist(), return_damage.tolist())))
+
+#---------------------------------------------------------------------------
+# reachability: a cost grid per movement class, precomputed when the map loads,
+# searched with a bucket-queue dijkstra (walk costs are small integers).
+#
+
+# units whose walk_cost() agrees on every terrain share a movement class
+WALK_COST_VECTORS = []
+WALK_CLASS = {}
+for walk_unit in UNIT_TYPES.keys():
+    walk_costs = [0] + [walk_cost(walk_unit, terrain) for terrain in TERRAIN_NAMES[1:]]
+    if walk_costs not in WALK_COST_VECTORS:
+        WALK_COST_VECTORS.append(walk_costs)
+    WALK_CLASS[walk_unit] = WALK_COST_VECTORS.index(walk_costs)
+WALK_COST_TBL = numpy.array(WALK_COST_VECTORS, numpy.int16)
+
+class MoveGrid(object):
+    """terrain-only movement data for one map, indexed by pos = y*width + x:
+    a flat cost list per movement class and a neighbor table in xy_nbrs order.
+    planes is terrain_planes(board), e.g. memory-mapped from a map cache file."""
+    def __init__(self, board, planes=None):
+        self.width, self.height = board.width, board.height
+        if planes is None:
+            planes = self.terrain_planes(board)
+        self.cost_grids = [grid.ravel().tolist() for grid in planes[:-4]]
+        self.pos_xyidx = [(pos // self.width) * 1000 + pos % self.width
+                          for pos in range(self.width * self.height)]
+        self.nbrs = [[nbr for nbr in pos_nbrs if nbr >= 0]
+                     for pos_nbrs in planes[-4:].reshape(4, -1).T.tolist()]
+
+    @staticmethod
+    def terrain_planes(board):
+        """one int32 (movement classes + 4, height, width) array: the walk cost per
+        movement class, then the pos of each neighbor in xy_nbrs order, -1 if off the map."""
+        ypos, xpos = numpy.mgrid[0:board.height, 0:board.width]
+        nbr_planes = []
+        for xoff, yoff in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
+            nbx, nby = xpos + xoff, ypos + yoff
+            on_map = (0 <= nbx) & (nbx < board.width) & (0 <= nby) & (nby < board.height)
+            nbr_planes.append(numpy.where(on_map, nby * board.width + nbx, -1))
+        return numpy.concatenate([WALK_COST_TBL[:, board.terrain],
+                                  nbr_planes]).astype(numpy.int32)
+
+    def pos(self, tile):
+        return tile['y'] * self.width + tile['x']
+
+    def reachable(self, unit_type, start, budget, blocked):
+        """returns {pos: predecessor pos} for every tile reachable within budget, cheapest
+        first.  like the game (and the old recursive walk), entering a tile costs its walk
+        cost, including the unit's own tile.  blocked is a set of impassable positions."""
+        grid, nbrs = self.cost_grids[WALK_CLASS[unit_type]], self.nbrs
+        start_cost = grid[start]
+        if start_cost == 0 or start_cost > budget: return {}
+        best, preds = {start: start_cost}, {}
+        buckets = [[] for _ in range(budget+1)]
+        buckets[start_cost].append((start, None))
+        for cost in range(start_cost, budget+1):
+            for pos, pred in buckets[cost]:
+                if pos in preds: continue   # already settled more cheaply
+                preds[pos] = pred
+                for nbr in nbrs[pos]:
+                    new_cost = cost + grid[nbr]
+                    if (new_cost == cost or new_cost > budget or nbr in blocked or
+                            new_cost >= best.get(nbr, budget+1)):
+                        continue
+                    best[nbr] = new_cost
+                    buckets[new_cost].append((nbr, pos))
+        return preds
+
+    def visit_order(self, unit_type, start, budget, blocked):
+        """the reachable positions in the order the old recursive walk found them (a
+        depth-first walk that re-enters a tile whenever it arrives with more budget
+        left), which iter_moves' candidate order, and so seeded games, depend on."""
+        grid, nbrs = self.cost_grids[WALK_CLASS[unit_type]], self.nbrs
+        seen, order = {}, {}
+        stack = [(iter([start]), budget)]
+        while stack:
+            pos = next(stack[-1][0], None)
+            if pos is None:
+                stack.pop()
+                continue
+            remaining = stack[-1][1]
+            cost = grid[pos]
+            if cost == 0 or remaining < cost: continue
+            seen[pos] = remaining
+            order[pos] = None
+            stack.append((iter([nbr for nbr in nbrs[pos] if remaining > seen.get(nbr, 0)
+                                and nbr not in blocked]), remaining - cost))
+        return list(order)
+
+    def path(self, preds, pos):
+        """xyidx of the tiles strictly between the start and pos."""
+        res = []
+        pos = preds[pos]
+        while pos is not None and preds[pos] is not None:
+            res.append(self.pos_xyidx[pos])
+            pos = preds[pos]
+        res.reverse()
+        return res
+
+def walkable_paths(state, unit, budget, blocked):
+    """{xyidx: path} for every tile unit can reach, in visit_order(), where path is
+    the cheapest list of tiles strictly between the unit and that tile."""
+    move_grid, tiles_by_idx = state.move_grid, state.tiles_by_idx
+    start = move_grid.pos(unit)
+    preds = move_grid.reachable(unit['unit_name'], start, budget, blocked)
+    paths = dict([(move_grid.pos_xyidx[pos], [tiles_by_idx[xyidx] for xyidx in
+                                              move_grid.path(preds, pos)])
+                  for pos in move_grid.visit_order(unit['unit_name'], start, budget, blocked)])
+    if DBG_MOVEMENT:
+        DBGPRINT('walkable_paths(unit={}, budget={}): {}'.format(
+            tilestr(unit), budget, "; ".join(['{} via {}'.format(
+                xyidxstr(xyidx), pathstr(path)) for xyidx, path in paths.items()])))
+    return paths
+
+def enemy_positions(state):
+    """positions a unit can't walk through: enemies (friends are fine).  like the old
+    walk, enemies whose tiles set_fog_values() has since fogged over don't block."""
+    return set([state.move_grid.pos(tile) for tile in state.enemy_units
+                if tile.get('unit_army_id') is not None])
+
+#---------------------------------------------------------------------------
+# vision: the numpy form of is_visible.  each unit stamps the diamond it sees
+# (forests only from next door) into a per-tile count of viewers; a tile is in
+# fog when nobody sees it.  counts rather than an OR, so a move can be applied
+# by re-stamping just the units it moved, killed or created.
+#
+
+class VisionGrid(object):
+    """terrain-only vision data for one map: forest mask and stamps by radius."""
+    def __init__(self, board):
+        self.width, self.height = board.width, board.height
+        self.forest = (board.terrain == TERRAIN_CODES['Forest'])
+        self.on_map = (board.terrain != 0)
+        self.stamps = {}
+
+    def stamp_masks(self, vision):
+        """(in vision range, adjacent) masks over a (2*vision+1)-square window."""
+        if vision not in self.stamps:
+            offsets = numpy.abs(numpy.arange(-vision, vision+1))
+            distance = offsets[:, None] + offsets[None, :]
+            self.stamps[vision] = (distance <= vision, distance <= 1)
+        return self.stamps[vision]
+
+    def stamp(self, counts, unit, sign=1):
+        """add (or with sign=-1, remove) unit as a viewer of every tile it sees."""
+        vision, xpos, ypos = UNIT_TYPES[unit['unit_name']]['vision'], unit['x'], unit['y']
+        in_range, adjacent = self.stamp_masks(vision)
+        ymin, ymax = max(0, ypos-vision), min(self.height, ypos+vision+1)
+        xmin, xmax = max(0, xpos-vision), min(self.width, xpos+vision+1)
+        window = (slice(ymin-ypos+vision, ymax-ypos+vision),
+                  slice(xmin-xpos+vision, xmax-xpos+vision))
+        seen = in_range[window] & (adjacent[window] | ~self.forest[ymin:ymax, xmin:xmax])
+        if sign > 0:
+            counts[ymin:ymax, xmin:xmax] += seen
+        else:
+            counts[ymin:ymax, xmin:xmax] -= seen
+
+    def viewer_counts(self, units):
+        counts = numpy.zeros((self.height, self.width), numpy.int16)
+        for unit in units:
+            self.stamp(counts, unit)
+        return counts
+
+    def num_visible(self, counts):
+        return int(numpy.count_nonzero(counts[self.on_map]))
+
+def army_viewer(army_id, tile):
+    """unit_name of army_id's unit on tile, else None (see player_units)."""
+    return tile.get('unit_name') if tile.get('unit_army_id') == army_id else None
+
+class ArmyVision(object):
+    """state's viewer counts, reused across candidate moves:
+    num_visible(journal) re-stamps only the tiles that apply_move touched."""
+    def __init__(self, state):
+        self.army_id, self.vision_grid = state.army_id, state.vision_grid
+        units = player_units(state.army_id, state.tiles_by_idx)
+        self.counts = self.vision_grid.viewer_counts(units)
+        self.viewers = dict([(unit['xyidx'], unit['unit_name']) for unit in units])
+
+    def num_visible(self, journal=None):
+        """visible tiles after the move recorded in journal (see apply_move)."""
+        touched = dict([(id(mydict), mydict) for mydict, _, _ in (journal or [])
+                        if 'xyidx' in mydict])
+        counts = None
+        for tile in touched.values():
+            old_viewer = self.viewers.get(tile['xyidx'])
+            new_viewer = army_viewer(self.army_id, tile)
+            if old_viewer == new_viewer: continue
+            if counts is None:
+                counts = self.counts.copy()
+            if old_viewer is not None:
+                self.vision_grid.stamp(
+                    counts, {'unit_name': old_viewer, 'x': tile['x'], 'y': tile['y']}, -1)
+            if new_viewer is not None:
+                self.vision_grid.stamp(counts, tile)
+        return self.vision_grid.num_visible(self.counts if counts is None else counts)
+
+#---------------------------------------------------------------------------
+# map templates: the terrain-only part of a parse -- the terrain planes, MoveGrid,
+# VisionGrid and the capturable tiles -- done once per map and shared by every
+# game on it, so a request only overlays its units, buildings and fog.  keyed by
+# map_name plus a digest of the terrain, so maps edited under the same name (or
+# sent without one) can't collide.  with MAP_CACHE_DIR, a template's planes are
+# saved as <map_name>-<digest>.npy, and other processes memory-map them on
+# first use instead of recomputing.
+#
 
-def dist_from_enemy_hq(tile):
-    return dist(OTHER_HQ[0], tile)
+MAP_TEMPLATES = BoundedStore(64)     # (map_name, terrain digest) => MapTemplate
+TILEMAP_TILES = BoundedStore(64)     # upper-cased __tilemap rows => decode_tilemap
+CAPTURABLE_CODES = [TERRAIN_CODES[name] for name in sorted(CAPTURABLE_TERRAIN)]
+
+class MapTemplate(object):
+    """base is an ArrayBoard of the bare terrain: no units or owners, nothing in fog
+    and full capture_remaining.  planes is MoveGrid.terrain_planes(base)."""
+    def __init__(self, base, planes=None):
+        self.base = base
+        self.move_grid = MoveGrid(base, planes)
+        self.vision_grid = VisionGrid(base)
+        self.capturable = [int(ypos) * 1000 + int(xpos) for ypos, xpos in
+                           zip(*numpy.nonzero(numpy.isin(base.terrain, CAPTURABLE_CODES)))]
+
+    @classmethod
+    def from_tiles_by_idx(cls, tiles_by_idx):
+        return cls(ArrayBoard.from_tiles_by_idx(dict([
+            (xyidx, {'x': tile['x'], 'y': tile['y'], 'terrain_name': tile['terrain_name']})
+            for xyidx, tile in tiles_by_idx.items()])))
+
+    @classmethod
+    def from_planes(cls, planes):
+        """inverse of planes()."""
+        height, width = planes.shape[1:]
+        base = ArrayBoard(width, height)
+        base.terrain[:] = planes[0]
+        base.capture_remaining[base.terrain != 0] = get_capture_remaining({})
+        return cls(base, planes[1:])
+
+    def planes(self):
+        return numpy.concatenate([self.base.terrain[None].astype(numpy.int32),
+                                  MoveGrid.terrain_planes(self.base)])
+
+    def board(self, tiles_by_idx):
+        """ArrayBoard.from_tiles_by_idx(tiles_by_idx), for tiles on this map:
+        only tiles with units or buildings are encoded one by one, fog in one go."""
+        board = self.base.copy()
+        fog_ypos, fog_xpos = [], []
+        for tile in tiles_by_idx.values():
+            if (has_army_unit(tile) or bldg_army_id(tile) != 0 or
+                    get_capture_remaining(tile) != 20):
+                board.update_tile(tile)
+            elif tile.get('in_fog') == '1':
+                fog_ypos.append(tile['y'])
+                fog_xpos.append(tile['x'])
+        board.in_fog[fog_ypos, fog_xpos] = 1
+        return board
+
+def terrain_digest(tiles_by_idx):
+    """identifies the terrain layout, and the code tables templates are built with."""
+    sha = hashlib.sha1(repr((TERRAIN_NAMES, WALK_COST_TBL.tolist())).encode('utf-8'))
+    sha.update('|'.join(['{}:{}'.format(xyidx, tiles_by_idx[xyidx]['terrain_name'])
+                         for xyidx in sorted(tiles_by_idx)]).encode('utf-8'))
+    return sha.hexdigest()
+
+def map_cache_path(map_name, digest):
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', map_name) or 'map'
+    return os.path.join(MAP_CACHE_DIR, '{}-{}.npy'.format(safe_name, digest[:16]))
+
+def load_map_template(path):
+    """the MapTemplate saved at path, memory-mapped, or None."""
+    if not os.path.exists(path):
+        return None
+    try:
+        planes = numpy.load(path, mmap_mode='r')
+        if planes.ndim != 3 or planes.shape[0] != len(WALK_COST_TBL) + 5:
+            raise ValueError('unexpected shape {}'.format(planes.shape))
+        return MapTemplate.from_planes(planes)
+    except (OSError, ValueError) as exc:
+        DBGPRINT('map cache: ignoring {}: {}'.format(path, exc))
+        return None
+
+def save_map_template(path, template):
+    """write-then-rename, so concurrent servers never see a partial file."""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(MAP_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'wb') as tmp_fh:
+            numpy.save(tmp_fh, template.planes())
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        DBGPRINT('map cache: not saving {}: {}'.format(path, exc))
+
+def map_template(map_name, tiles_by_idx):
+    """the MapTemplate for tiles_by_idx's terrain: from memory, else from
+    MAP_CACHE_DIR, else built (and saved there)."""
+    digest = terrain_digest(tiles_by_idx)
+    template = MAP_TEMPLATES.get((map_name, digest))
+    if template is None:
+        path = map_cache_path(map_name, digest) if MAP_CACHE_DIR else None
+        template = load_map_template(path) if path else None
+        if template is None:
+            template = MapTemplate.from_tiles_by_idx(tiles_by_idx)
+            if path:
+                save_map_template(path, template)
+        MAP_TEMPLATES.put((map_name, digest), template)
+    return template
+
+def dist_from_enemy_hq(state, tile):
+    return dist(state.other_hq[0], tile)
 
 def name_val_dict_str(mydict):
     return " ".join([('{}={:3s}' if key in ['fuel','health'] else '{}={}').format(
@@ -639,29 +1484,56 @@ def units_by_dist(my_units, other_hq):
         for unit in sorted_units:
             dbg_units.append("{}{}: {:.0f} from enemy hq [{},{}]: {}".format(
                 "moved " if str(unit['moved'])=='1' else "", tilestr(unit),
-                dist_from_enemy_hq(unit), other_hq['x'], other_hq['y'],
+                dist(other_hq, unit), other_hq['x'], other_hq['y'],
                 tile_details_str(unit, ['moved'])))
         DBGPRINT("\n".join(dbg_units))
     return sorted_units
 
-def my_units_by_dist():
-    return units_by_dist(MY_UNITS, OTHER_HQ[0])
+def my_units_by_dist(state):
+    return units_by_dist(state.my_units, state.other_hq[0])
 
-def msec(timedelta):
-    return timedelta.seconds*1000 + int(timedelta.microseconds/1000)
+def msec(seconds):
+    return int(seconds * 1000)
 
-def cache_move(res, moves):
-    res_hash = json.dumps(res)
-    if res_hash in moves:
+def response_deadline(max_msec=None, start=None):
+    """time.monotonic() deadline for a response started at start (default now), from
+    max_msec or MAX_RESPONSE_MSEC; None if there's no budget."""
+    try:
+        max_msec = int(max_msec or MAX_RESPONSE_MSEC)
+    except (TypeError, ValueError):
+        # a malformed maxResponseMsec shouldn't fail the request
+        max_msec = MAX_RESPONSE_MSEC
+    if max_msec <= 0:
+        return None
+    return (time.monotonic() if start is None else start) + max_msec / 1000.0
+
+def past_deadline(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+def split_deadline(deadline):
+    """the point at which to stop finding moves and start scoring them."""
+    if deadline is None:
+        return None
+    now = time.monotonic()
+    return now + max(0.0, deadline - now) / 2.0
+
+# scoring order under a deadline: the kinds most likely to be picked come first
+MOVE_KIND_PRIORITY = ['attack', 'capture', 'join', 'unload', 'load', 'move', 'purchase',
+                      'end_turn']
+
+def move_key(kind, src_xyidx, dest_xyidx=None, action_xyidx=None, unit_name=None):
+    """canonical identity of a candidate move, built during generation:
+    (kind, src xyidx, dest xyidx, action/attack xyidx, unit type).
+    moves with equal keys are the same move on the wire."""
+    return (kind, src_xyidx, dest_xyidx, action_xyidx, unit_name)
+
+def cache_move(key, build_move, moves):
+    """dedupe on the move key; build_move() only runs for keys not seen yet."""
+    if key in moves:
         return False
-    moves[res_hash] = res
+    moves[key] = build_move()
     return True
 
-def copy_move(move, update):
-    new_move = copy.deepcopy(move)
-    new_move.update(update)
-    return new_move
-
 def copy_tile_exc_loc(tile):
     return dict( [(key, val) for key, val in tile.items() if key not in TILE_LOC_FIELDS] )
 
@@ -681,13 +1553,46 @@ def is_loaded_skateboard(unit):
     return unit.get('unit_name') == 'Skateboard' and \
         unit.get('slot1_deployed_unit_name', '') not in [None, '']
 
-def enumerate_moves(player_id, army_id, game_info, players, moves):
-    # subtle: we enumerate the logical moves in order, so after N moves it's highly unlikely
-    # that we'll pick a less-logical move, e.g. a simple_movement when there's a possible
-    # attack or capture.
-    if len(moves) > CLIP_POSS_MOVES: return
-    
-    my_info = players[player_id]
+def movement_move(unit, dest, path, unit_max_move, update=None):
+    """mkres() for unit walking path to dest (standing still if dest is unit),
+    plus update, e.g. an attack."""
+    unit_type = unit['unit_name']
+    move = { 'x_coordinate': unit['x_coordinate'], 'y_coordinate': unit['y_coordinate'] }
+    if dest['xy'] == unit['xy']:
+        move.update(
+            { '__unit_name': unit_type, '__unit_action': 'no_movement', 'movements': [] })
+    else:
+        move.update(
+            { '__unit_name': unit_type, '__unit_action': 'simple_movement',
+              '__unit_max_move': unit_max_move,
+              'movements': [ { "xCoordinate": p['x'], "yCoordinate": p['y'],
+                               '__walkcost': walk_cost(unit_type, p['terrain_name']),
+                               '__terrain': p['terrain_name'] }
+                             for p in (path + [dest])] })
+    if update:
+        move.update(update)
+    return mkres(move=move)
+
+def load_move(ldable, load_path):
+    return mkres(move={
+        'x_coordinate': ldable['x_coordinate'], 'y_coordinate': ldable['y_coordinate'],
+        '__unit_name': ldable['unit_name'], '__unit_action': 'load',
+        'unit_action': 'load', 'movements': [ {
+            "xCoordinate": p['x'], "yCoordinate": p['y'],
+            '__walkcost': walk_cost(ldable['unit_name'], p['terrain_name']),
+            '__terrain': p['terrain_name'] } for p in load_path ]})
+
+# written onto tiles by iter_moves, i.e. not part of the parsed board
+SCRATCH_TILE_FIELDS = ['__mvclasses', 'pathstr']
+
+def iter_moves(state, player_id, game_info, players):
+    """generates (move_key, build_move) for every candidate move in one pass over my
+    units, walking each unit's reachable set once.  the move dict is only built when
+    the caller runs build_move(), i.e. after dedup (see cache_move); keys may repeat.
+    subtle: we enumerate the logical moves in order, so after N moves it's highly unlikely
+    that we'll pick a less-logical move, e.g. a simple_movement when there's a possible
+    attack or capture."""
+    my_info, army_id = players[player_id], state.army_id
     # debug hack to force the algorithm to 'pick' this tile for the move,
     # building units at a castle, moving a unit, etc.
     dbg_force_tile = game_info.get('dbg_force_tile', '')   # x,y padded with zeroes, e.g. 04,14
@@ -695,18 +1600,20 @@ def enumerate_moves(player_id, army_id, game_info, players, moves):
 
     # unit movement, incl loading/unloading
     dbg_nbrs = []
-    for unit in my_units_by_dist():
+    units_in_order = my_units_by_dist(state)
+    blocked = enemy_positions(state)
+    for unit in units_in_order:
         unit['__mvclasses'] = {}
         if unit.get('dbg_force_tile') == True:
             dbg_force_tile = unit['xy']
-    for unit in my_units_by_dist():
+    for unit in units_in_order:
         if str(unit['moved'])=='1': continue
         if dbg_force_tile not in ['', unit['xy']]: continue
         unit_type = unit['unit_name']
 
         # decide on unloading first -- this makes it possible to unload/reload in one turn
         if is_loaded_unicorn(unit) or is_loaded_skateboard(unit):
-            valid_neighbors = [nbr for nbr in immed_nbrs(unit) if nbr.get('unit_name') is None and
+            valid_neighbors = [nbr for nbr in immed_nbrs(unit, state.tiles_by_idx) if nbr.get('unit_name') is None and
                                nbr['terrain_name'] in WALKABLE_TERRAIN]
             for nbr in valid_neighbors:
                 unload_move = {
@@ -714,53 +1621,41 @@ def enumerate_moves(player_id, army_id, game_info, players, moves):
                     'x_coord_action': nbr['x_coordinate'], 'y_coord_action': nbr['y_coordinate'],
                     '__unit_name': unit['slot1_deployed_unit_name'], '__unit_action': 'unload',
                     'movements': [], 'unit_action': 'unloadSlot1' }
-                if cache_move(mkres(move=unload_move), moves):
-                    if DBG_LOADING:
-                        DBGPRINT('loaded, unmoved unicorn: {} unload to {}'.format(
-                            tilestr(unit), tilestr(nbr)))
-                    return mkres(move=unload_move)
+                if DBG_LOADING:
+                    DBGPRINT('loaded, unmoved unicorn: {} unload to {}'.format(
+                        tilestr(unit), tilestr(nbr)))
+                yield (move_key('unload', unit['xyidx'], unit['xyidx'], nbr['xyidx'],
+                                unit['slot1_deployed_unit_name']),
+                       functools.partial(mkres, move=unload_move))
 
         # decide on unicorn (re)loading next -- possible unload/reload/move/unload all in one turn
         if is_unloaded_unicorn(unit) or is_unloaded_skateboard(unit):
             carrier = unit
-            for ldable in MY_UNITS:
+            for ldable in state.my_units:
                 if ldable['moved'] == '1' or ldable['unit_name'] not in LOADABLE_UNITS: continue
                 if dist(carrier, ldable) > ldable['unit_type']['move']: continue
                 if DBG_LOADING:
                     DBGPRINT('unloaded {} {}: checking loadable in range: {}'.format(
                         unit['unit_name'], tilestr(unit), tilestr(ldable)))
-                walk_dests = walkable_tiles(
-                    ldable, army_id, ldable, ldable['unit_type']['move'], [])
-                for walk_dest in walk_dests:
-                    if carrier['xy'] != walk_dest['xy']: continue
-                    if DBG_LOADING:
-                        DBGPRINT('walkdest: {} + {}'.format(
-                            pathstr(walk_dest['path']), tilestr(walk_dest)))
-                    walk_dest['path'].append(walk_dest)
-                    if DBG_LOADING:
-                        DBGPRINT('unloaded {} {}: {} walk to {} via {}'.format(
-                            unit['unit_name'], tilestr(unit), tilestr(ldable),
-                            tilestr(walk_dest), pathstr(walk_dest['path'])))
-                    load_move = {
-                        'x_coordinate': ldable['x_coordinate'],
-                        'y_coordinate': ldable['y_coordinate'],
-                        '__unit_name': ldable['unit_name'], '__unit_action': 'load',
-                        'unit_action': 'load', 'movements': [ {
-                            "xCoordinate": p['x'], "yCoordinate": p['y'],
-                            '__walkcost': walk_cost(ldable['unit_name'], p['terrain_name']),
-                            '__terrain': p['terrain_name'] } for p in walk_dest['path'] ]}
-                    if cache_move(mkres(move=load_move), moves):
-                        if DBG_LOADING:
-                            DBGPRINT('unloaded {} found: {} -- loading {} via {}'.format(
-                                unit['unit_name'], tilestr(unit), tilestr(ldable), pathstr(walk_dest['path'])))
-                        return mkres(move=load_move)
+                ld_paths = walkable_paths(state, ldable, ldable['unit_type']['move'], blocked)
+                if carrier['xyidx'] not in ld_paths: continue
+                load_path = ld_paths[carrier['xyidx']] + [carrier]
+                if DBG_LOADING:
+                    DBGPRINT('unloaded {} {}: {} walk to {} via {}'.format(
+                        unit['unit_name'], tilestr(unit), tilestr(ldable),
+                        tilestr(carrier), pathstr(load_path)))
+                if DBG_LOADING:
+                    DBGPRINT('unloaded {} found: {} -- loading {} via {}'.format(
+                        unit['unit_name'], tilestr(unit), tilestr(ldable), pathstr(load_path)))
+                yield (move_key('load', ldable['xyidx'], carrier['xyidx'], None,
+                                ldable['unit_name']),
+                       functools.partial(load_move, ldable, load_path))
 
         # moves
-        for tile in TILES_BY_IDX.values():
-            tile['seen'], tile['path'] = 0, None
-        unit['seen'], unit['path'] = 1, []
         unit_max_move = max_travel(unit)
-        neighbors = walkable_tiles(unit, army_id, unit, unit_max_move, [])
+        paths = walkable_paths(state, unit, unit_max_move, blocked)
+        paths.setdefault(unit['xyidx'], [])
+        neighbors = [state.tiles_by_idx[xyidx] for xyidx in paths]
         # only include our own units if joinable
         neighbors = [nbr for nbr in neighbors if nbr.get('unit_army_id') is None or
                      (nbr.get('unit_army_id') == army_id and
@@ -770,66 +1665,61 @@ def enumerate_moves(player_id, army_id, game_info, players, moves):
                       unit_health(nbr) + unit_health(unit) <= MAX_JOIN_THRESHOLD ) ]
         # not moving is a valid choice
         neighbors.append(unit)
-        uniq_neighbors = {}
-        for nbr in neighbors:
-            nbr['pathstr'] = pathstr([nbr]+nbr['path'])
-            uniq_neighbors[nbr['xystr']] = nbr
-
-        dbg_nbrs.append("walkable neighbors of {}, move={}:".format(tilestr(unit), unit_max_move))
-        for nbr in sorted_tiles(list(uniq_neighbors.values())):
-            dbg_nbrs.append("{} via {}".format(
-                tilestr(nbr), pathstr(nbr['path'], show_terrain=True)))
+        uniq_neighbors = dict([(nbr['xystr'], nbr) for nbr in neighbors])
+
         if DBG_MOVEMENT:
+            for nbr in neighbors:
+                nbr['pathstr'] = pathstr([nbr]+paths[nbr['xyidx']])
+            dbg_nbrs.append("walkable neighbors of {}, move={}:".format(
+                tilestr(unit), unit_max_move))
+            for nbr in sorted_tiles(list(uniq_neighbors.values())):
+                dbg_nbrs.append("{} via {}".format(
+                    tilestr(nbr), pathstr(paths[nbr['xyidx']], show_terrain=True)))
             DBGPRINT("\n".join(dbg_nbrs))
             
         for dest in list(uniq_neighbors.values()):
             #DBGPRINT("checking src={} dest={}".format(tilestr(unit), tilestr(dest)))
-            move = { 'x_coordinate': unit['x_coordinate'], 'y_coordinate': unit['y_coordinate'] }
-            if dest['xy'] == unit['xy']:
+            src_xyidx, dest_xyidx = unit['xyidx'], dest['xyidx']
+            # binds this dest's path: build_move() may run after the loop moves on
+            dest_move = functools.partial(
+                movement_move, unit, dest, paths[dest_xyidx], unit_max_move)
+            if DBG_MOVEMENT and dest['xy'] == unit['xy']:
                 dbg_nbrs.append("no movement for {}, move={}:".format(
                     tilestr(unit), unit_max_move))
-                move.update(
-                    { '__unit_name': unit_type, '__unit_action': 'no_movement', 'movements': [] })
-            else:
-                move.update(
-                    { '__unit_name': unit_type, '__unit_action': 'simple_movement',
-                      '__unit_max_move': unit_max_move,
-                      'movements': [ { "xCoordinate": p['x'], "yCoordinate": p['y'],
-                                       '__walkcost': walk_cost(unit_type, p['terrain_name']),
-                                       '__terrain': p['terrain_name'] }
-                                     for p in (dest['path'] + [dest])] })
 
             # join units
             if (dest['xy'] != unit['xy'] and dest.get('unit_army_id') == army_id and
                 dest['unit_name'] == unit['unit_name']):
-                dbg_nbrs.append("join units for {}, move={}:".format(
-                    tilestr(unit), unit_max_move))
-                join_move = copy_move(move, {'unit_action': 'join', '__action': 'join'})
-                if cache_move(mkres(move=join_move), moves): return mkres(move=join_move)
+                if DBG_MOVEMENT:
+                    dbg_nbrs.append("join units for {}, move={}:".format(
+                        tilestr(unit), unit_max_move))
+                yield (move_key('join', src_xyidx, dest_xyidx, None, unit_type),
+                       functools.partial(dest_move, {'unit_action': 'join', '__action': 'join'}))
                 # only join's are allowed on occupied tiles
                 continue
 
             # capture open towns, castles and headquarters
             if can_capture(unit, dest, army_id):
-                capture_move = copy_move(move, {'unit_action': 'capture', '__action': 'capture'})
-                if cache_move(mkres(move=capture_move), moves): return mkres(move=capture_move)
+                yield (move_key('capture', src_xyidx, dest_xyidx, None, unit_type),
+                       functools.partial(dest_move, {'unit_action': 'capture',
+                                                     '__action': 'capture'}))
 
             # unload after move
             if is_loaded_unicorn(unit) or is_loaded_skateboard(unit):
-                valid_neighbors = [nbr for nbr in immed_nbrs(dest) if
+                valid_neighbors = [nbr for nbr in immed_nbrs(dest, state.tiles_by_idx) if
                                    nbr.get('unit_name') is None and
                                    nbr['terrain_name'] in WALKABLE_TERRAIN]
                 for nbr in valid_neighbors:
-                    unload_move = copy_move(move, {
-                        'x_coord_action': nbr['x_coordinate'],
-                        'y_coord_action': nbr['y_coordinate'],
-                        '__unit_name': unit['slot1_deployed_unit_name'], '__unit_action': 'unload',
-                        'unit_action': 'unloadSlot1' })
-                    if cache_move(mkres(move=unload_move), moves):
-                        if DBG_LOADING:
-                            DBGPRINT('loaded, moved {} {} -> {}, unload to {}'.format(
-                                unit['unit_name'], tilestr(unit), tilestr(dest), tilestr(nbr)))
-                        return mkres(move=unload_move)
+                    if DBG_LOADING:
+                        DBGPRINT('loaded, moved {} {} -> {}, unload to {}'.format(
+                            unit['unit_name'], tilestr(unit), tilestr(dest), tilestr(nbr)))
+                    yield (move_key('unload', src_xyidx, dest_xyidx, nbr['xyidx'],
+                                    unit['slot1_deployed_unit_name']),
+                           functools.partial(dest_move, {
+                               'x_coord_action': nbr['x_coordinate'],
+                               'y_coord_action': nbr['y_coordinate'],
+                               '__unit_name': unit['slot1_deployed_unit_name'],
+                               '__unit_action': 'unload', 'unit_action': 'unloadSlot1' }))
             
             # attacks
             if unit_type in ATTACKING_UNITS:
@@ -837,15 +1727,15 @@ def enumerate_moves(player_id, army_id, game_info, players, moves):
                 attack_tile = unit if unit_type in MISSILE_UNITS else dest
                 atkmin = unit['unit_type']['atkmin']
                 atkmax = unit['unit_type']['atkmax']
-                attack_neighbors = [enemy_unit for enemy_unit in ENEMY_UNITS
+                attack_neighbors = [enemy_unit for enemy_unit in state.enemy_units
                                     if atkmin <= dist(attack_tile, enemy_unit) <= atkmax]
                 if DBG_NOTABLE_TILES:
                     dbgmsgs = [ "enemy units from {}".format(tilestr(attack_tile)) ]
                     dbgmsgs.append("\n".join(["{}: {}".format(
                         dist(attack_tile, enemy_unit), tilestr(enemy_unit))
-                                              for enemy_unit in ENEMY_UNITS]))
+                                              for enemy_unit in state.enemy_units]))
                     dbgmsgs.append("attack_neighbors for {}: {}".format(
-                        tilestr(dest), "\n".join([pathstr(tile['path'])
+                        tilestr(dest), "\n".join([pathstr(paths.get(tile['xyidx']))
                                                   for tile in attack_neighbors])))
                 for attack_neighbor in attack_neighbors:
                     if DBG_NOTABLE_TILES:
@@ -853,94 +1743,143 @@ def enumerate_moves(player_id, army_id, game_info, players, moves):
                     if attack_neighbor.get('unit_army_id', '') not in ['', None, army_id]:
                         if DBG_NOTABLE_TILES:
                             dbgmsgs.append("attacking: {}".format(tilestr(attack_neighbor)))
+                        attack = { 'x_coord_attack': attack_neighbor['x'],
+                                   'y_coord_attack': attack_neighbor['y'] }
                         # missile units: don't move, just attack
-                        attack_move = copy_move(move, {
-                            'x_coord_attack': attack_neighbor['x'],
-                            'y_coord_attack': attack_neighbor['y'] })
                         if unit_type in MISSILE_UNITS:
-                            attack_move.update({ '__action': 'missile_attack', 'movements': [] })
+                            attack.update({ '__action': 'missile_attack', 'movements': [] })
+                            attack_dest_xyidx = src_xyidx
                         else:
-                            attack_move.update({ '__action': 'ground_attack' })
-                        if cache_move(mkres(move=attack_move), moves):
-                            if DBG_NOTABLE_TILES:
-                                DBGPRINT("\n".join(dbgmsgs))
-                            return mkres(move=attack_move)
+                            attack.update({ '__action': 'ground_attack' })
+                            attack_dest_xyidx = dest_xyidx
+                        if DBG_NOTABLE_TILES:
+                            DBGPRINT("\n".join(dbgmsgs))
+                        yield (move_key('attack', src_xyidx, attack_dest_xyidx,
+                                        attack_neighbor['xyidx'], unit_type),
+                               functools.partial(dest_move, attack))
             # simple moves
-            if cache_move(mkres(move=move), moves):
-                return mkres(move=move)
+            yield move_key('move', src_xyidx, dest_xyidx, None, unit_type), dest_move
 
     # build new units at castles
-    my_castles_by_dist = sorted(MY_CASTLES, key=dist_from_enemy_hq)
+    my_castles_by_dist = sorted(state.my_castles, key=lambda castle: dist_from_enemy_hq(state, castle))
     if DBG_NOTABLE_TILES:
         dbg_castles = ["castles by distance:"]
         for castle in my_castles_by_dist:
             dbg_castles.append("{}: {:.1f} from enemy hq @{}".format(
-                tilestr(castle, show_details=True), dist_from_enemy_hq(castle),
-                tile2xystr(OTHER_HQ[0])))
+                tilestr(castle, show_details=True), dist_from_enemy_hq(state, castle),
+                tile2xystr(state.other_hq[0])))
         DBGPRINT("\n".join(dbg_castles))
     funds = int(my_info['funds'])
     for castle in my_castles_by_dist:
         if dbg_force_tile not in [None, '', castle['xy']]: continue
         if castle.get('unit_army_name') in [None, ''] and funds >= 1000:
             for purch_unit_name in [k for k,v in UNIT_TYPES.items() if v['cost'] <= funds]:
-                res = mkres(purchase={
-                    'x_coordinate': castle['x_coordinate'], 'y_coordinate': castle['y_coordinate'],
-                    'unit_name': purch_unit_name })
-                if cache_move(res, moves): return res
+                yield (move_key('purchase', castle['xyidx'], castle['xyidx'], None,
+                                purch_unit_name),
+                       functools.partial(mkres, purchase={
+                           'x_coordinate': castle['x_coordinate'],
+                           'y_coordinate': castle['y_coordinate'],
+                           'unit_name': purch_unit_name }))
 
     # run out of possible moves
-    if cache_move(mkres(end_turn=True), moves): return mkres(end_turn=True)
-    return None
+    yield move_key('end_turn', None), functools.partial(mkres, end_turn=True)
 
-def enumerate_all_moves_trapped(player_id, army_id, game_info, players, compute_score=True,
-                        result_queue=None, worker_num=None):
+def enumerate_all_moves_trapped(state, player_id, game_info, players, deadline=None):
     try:
-        return enumerate_all_moves(player_id, army_id, game_info, players, compute_score,
-                            result_queue, worker_num)
+        return enumerate_all_moves(state, player_id, game_info, players, deadline)
     except KeyboardInterrupt:
         pass # swallow KIs
 
-def enumerate_all_moves(player_id, army_id, game_info, players, compute_score=True,
-                        result_queue=None, worker_num=None):
-    #DBGPRINT("enumerate_all_moves({}, {}, {}, {}, {})\n\nTILES_BY_IDX: {}".format(
-    #    player_id, army_id, game_info, players, result_queue, len(TILES_BY_IDX))
-    next_move, moves = True, {}
+def enumerate_all_moves(state, player_id, game_info, players, deadline=None):
+    """moves in generation order, up to CLIP_POSS_MOVES or the deadline (see
+    split_deadline), whichever comes first.  never empty: when out of time before
+    anything was found, falls back to end_turn."""
+    moves = {}
     dbg_force_tile = game_info.get('dbg_force_tile', '')
-    if DBG_MOVES and dbg_force_tile != '':
-        DBGPRINT("dbg_force_tile: {}".format(dbg_force_tile))
-    while next_move is not None:
-        next_move = enumerate_moves(player_id, army_id, game_info, players, moves)
-        #if next_move is not None: DBGPRINT('next_move: {}'.format(next_move))
-    if result_queue is None:
-        return moves
-    if DBG_PARALLEL_MOVE_DISCOVERY:
-        DBGPRINT('{} {} queuing {} moves'.format(worker_num, os.getpid(), len(moves)))
-    retry_cnt = 0
-    moves_list = list(moves.values()) + [ {'stop_worker_num': worker_num} ]
-    for i, move in enumerate(moves_list):
-        if compute_score and move.get('stop_worker_num', '') == '':
-            move['__score'], move['__score_pos'], move['__score_details'] = score_move(
-                army_id, TILES_BY_IDX, players[player_id], move)
-        move_json = json.dumps(move)
-        while True:
-            try:
-                result_queue.put(move_json)
-            except:
-                retry_cnt += 1
-                if DBG_PARALLEL_MOVE_DISCOVERY:
-                    DBGPRINT('{} {} queue busy, sleeping and retrying {} bytes... {}'.format(
-                        worker_num, os.getpid(), len(move_json), retry_cnt))
-                time.sleep(1)
-                continue
-            else:
-                retry_cnt = 0
-                if DBG_PARALLEL_MOVE_DISCOVERY:
-                    DBGPRINT('{} {} queued move #{} of {} - {}'.format(
-                        worker_num, os.getpid(), i+1, len(moves_list),
-                        len(move_json) if move.get('stop_worker_num') is None else 'STOP'))
-                break
+    if dbg_force_tile != '':
+        trace(DBG_MOVES, "dbg_force_tile: {}", dbg_force_tile)
+    # CLIP_POSS_MOVES is a lazy cutoff: later (less logical) moves are never generated
+    for key, build_move in iter_moves(state, player_id, game_info, players):
+        cache_move(key, build_move, moves)
+        if len(moves) > CLIP_POSS_MOVES:
+            break
+        if past_deadline(deadline):
+            if DBG_TIMING:
+                DBGPRINT('deadline: stopped finding moves after {}'.format(len(moves)))
+            cache_move(move_key('end_turn', None), functools.partial(mkres, end_turn=True),
+                       moves)
+            break
+    return moves
+
+#---------------------------------------------------------------------------
+# parallel move discovery: a pool started once per process (server or sim), fed
+# chunks of unmoved units/castles.  each task enumerates and scores its tiles'
+# moves and returns them as one pickled batch.
+#
+
+POOL, POOL_SIZE = None, 0
+
+def ignore_sigint():
+    # ^C goes to the parent, which tears the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def start_worker_pool(processes=None):
+    """starts the shared pool, if it isn't running.  call early, e.g. before the server
+    starts threads: workers are forked from the caller."""
+    global POOL, POOL_SIZE
+    if POOL is None:
+        POOL_SIZE = processes or PARALLEL_WORKERS or multiprocessing.cpu_count()
+        POOL = multiprocessing.Pool(POOL_SIZE, ignore_sigint)
+    return POOL
+
+def stop_worker_pool():
+    global POOL, POOL_SIZE
+    if POOL is not None:
+        POOL.terminate()
+        POOL.join()
+        POOL, POOL_SIZE = None, 0
+
+def discover_moves_task(task):
+    """pool task: (chunk_idx, state, player_id, players, force_tiles, deadline) =>
+    (chunk_idx, [(move_key, move), ...], seconds busy) for moves of the tiles in
+    force_tiles, already scored.  deadline is a time.monotonic() value, which is
+    system-wide."""
+    task_start = time.perf_counter()
+    chunk_idx, state, player_id, players, force_tiles, deadline = task
+    batch = []
+    enum_deadline = split_deadline(deadline)
+    for force_tile in force_tiles:
+        moves = enumerate_all_moves(state, player_id, {'dbg_force_tile': force_tile}, players,
+                                    enum_deadline)
+        score_moves(state, players[player_id], moves, deadline)
+        batch.extend(moves.items())
+        if past_deadline(enum_deadline):
+            break
     if DBG_PARALLEL_MOVE_DISCOVERY:
-        DBGPRINT('{} {} done queuing moves - returning.'.format(worker_num, os.getpid()))
+        DBGPRINT('worker {}: chunk #{} {} => {} moves'.format(
+            os.getpid(), chunk_idx, " ".join(force_tiles), len(batch)))
+    return chunk_idx, batch, time.perf_counter() - task_start
+
+def discover_moves_parallel(state, player_id, players, unmoved_tiles, deadline=None):
+    """moves for each of unmoved_tiles, as enumerated one tile at a time (see
+    dbg_force_tile), spread across the pool in one chunk per worker."""
+    pool = start_worker_pool()
+    num_chunks = min(len(unmoved_tiles), POOL_SIZE)
+    tasks = [(chunk_idx, state, player_id, players,
+              [tile['xy'] for tile in unmoved_tiles[chunk_idx::num_chunks]], deadline)
+             for chunk_idx in range(num_chunks)]
+    batches = [None] * num_chunks
+    pool_start = time.perf_counter()
+    for chunk_idx, batch, busy_time in pool.imap_unordered(discover_moves_task, tasks):
+        batches[chunk_idx] = batch
+        POOL_BUSY_SECONDS.inc(busy_time)
+    POOL_CAPACITY_SECONDS.inc((time.perf_counter() - pool_start) * POOL_SIZE)
+    # merge in chunk order, so the result doesn't depend on which worker finished first
+    moves = {}
+    for batch in batches:
+        for key, move in batch:
+            cache_move(key, lambda move=move: move, moves)
+    return moves
 
 def abbr_move_json(move):
     res = json.dumps(move, sort_keys=True)
@@ -957,12 +1896,12 @@ def compressed_tile(tile):
                              'terrain_name','in_fog'
                  ])
 
-def compressed_game_info(game_info, army_id):
+def compressed_game_info(game_info, army_id, tiles_by_idx):
     """encoded as tilemap and interesting tiles"""
-    game_info['__tilemap'] = tilemap_list(TILES_BY_IDX.values())
-    game_info['__unitmap'] = unitmap_list(TILES_BY_IDX.values(), army_id)
+    game_info['__tilemap'] = tilemap_list(tiles_by_idx.values())
+    game_info['__unitmap'] = unitmap_list(tiles_by_idx.values(), army_id)
     game_info['tiles'] = [[]]   # format is nested lists, but there's no meaning
-    for tile in TILES_BY_IDX.values():
+    for tile in tiles_by_idx.values():
         tile = compressed_tile(tile)
         # skip tiles that are fully encoded by the tilemap
         if tile.keys() == set(['xy']):
@@ -970,80 +1909,67 @@ def compressed_game_info(game_info, army_id):
         game_info['tiles'][0].append(tile)
     return game_info
 
-def select_next_move(player_id, game_info, preparsed=False):
-    """if preparsed, then TILES_BY_IDX is already set."""
-    if DBG_PRINT_SHORTCODES:
-        DBGPRINT("\n".join(["{}: {}".format(name, typ) for name, typ in
-                            sorted(TERRAIN_SHORTCODES.items())]))
-        DBGPRINT("\n".join(["{}: {}".format(name, typ) for name, typ in
-                            sorted(UNIT_SHORTCODES.items())]))
-    start_time = datetime.datetime.now()
-    if DBG_PARSE_TIMING:
-        parse_time = datetime.datetime.now() - start_time
-        DBGPRINT('JSON parse time: {}'.format(msec(parse_time)))
-
-    game_id = game_info['game_id']
-    if game_id not in GAMES:
-        GAMES[game_id] = { 'moves': [] }
+#---------------------------------------------------------------------------
+# per-game sessions: the server is called for every move of a turn, and each board
+# differs from the previous one by a move.  the game's GAMES entry keeps its last
+# parse as 'session', and the next request re-parses only the tiles whose JSON
+# changed.  a session is taken out of the entry while a request uses it.
+#
 
-    tiles, players = game_info['tiles'], game_info['players']
-    player_info = players[player_id]
-    army_id = player_info['army_id']
-    if not preparsed:
-        parse_map(army_id, tiles, game_info)
-    # save the request, for replay (low level debugging)
-    if DEBUG:
-        game_info_json = json.dumps(game_info, indent=2, sort_keys=True)
-        game_fh = open('game-{}.json'.format('game_id'), 'w')
-        game_fh.write('{} "botPlayerId": {}, "gameInfo": {} {}'.format(
-            "{", player_id, game_info_json, "}"))
-        game_fh.close()
-    tiles_list = TILES_BY_IDX.values()
-    if is_first_move_in_turn(game_info['game_id']):
-        DBGPRINT("board:\n" + combined_map(tiles_list, army_id))
-    unmoved_tiles = [unit for unit in (MY_UNITS + MY_CASTLES) if unit.get('moved') != '1']
-    # don't parallelize end_turn
-    if PARALLEL_MOVE_DISCOVERY and len(unmoved_tiles) > 0:
-        mpmgr = Manager()
-        moves, workers, result_queue = {}, [], mpmgr.Queue()
-        # dbg_force_tile also signals a child process, i.e. avoid infinite recursion
-        for unit in unmoved_tiles:
-            if DBG_PARALLEL_MOVE_DISCOVERY:
-                DBGPRINT("opening subprocess for unit: {}".format(tilestr(unit)))
-            game_info['dbg_force_tile'] = unit['xy']
-            worker = Process(target=enumerate_all_moves_trapped, args=(
-                player_id, army_id, game_info, players, True, result_queue, len(workers), ))
-            workers.append(worker)
-            worker.start()
-        if DBG_PARALLEL_MOVE_DISCOVERY:
-            DBGPRINT("waiting for subprocesses...")
-        cnt = 0
-        while True:
-            if DBG_PARALLEL_MOVE_DISCOVERY:
-                DBGPRINT('main proc {}: queue size: {}, {} workers.  fetching item...'.format(
-                    os.getpid(), result_queue.qsize(), sum([wrk is not None for wrk in workers])))
-            try:
-                qitem_json = result_queue.get_nowait()
-            except:
-                cnt += 1
-                if DBG_PARALLEL_MOVE_DISCOVERY:
-                    DBGPRINT('main proc {}: queue empty, {} workers, sleep/retry... {}'.format(
-                        os.getpid(), sum([wrk is not None for wrk in workers]), cnt))
-                time.sleep(1)
-                continue
-            cnt = 0
-            qitem = json.loads(qitem_json)
-            stop_worker_num = qitem.get('stop_worker_num')
-            if stop_worker_num is None:
-                cache_move(qitem, moves)
-                continue
-            if DBG_PARALLEL_MOVE_DISCOVERY:
-                DBGPRINT("stopping worker {}".format(stop_worker_num))
-            workers[stop_worker_num] = None
-            if not any(workers):
-                break
+class Session(object):
+    """a parsed board plus copies of the raw tile dicts it was parsed from."""
+    def __init__(self, army_id, raw_tiles, state):
+        self.army_id, self.raw_tiles, self.state = army_id, raw_tiles, state
+
+def session_state(game, army_id, tiles, game_info):
+    """parse_map(army_id, tiles, game_info), reusing the session in game (the game's
+    GAMES entry) if it can.  returns (state, session); put the session back in game
+    when done with state."""
+    flat_tiles = [tile for tile_ar in tiles for tile in tile_ar]
+    raw_tiles = [dict(tile) for tile in flat_tiles]
+    session = game.pop('session', None)
+    state = reparse_changed_tiles(session, army_id, flat_tiles, game_info)
+    if state is None:
+        state = parse_map(army_id, tiles, game_info)
+    return state, Session(army_id, raw_tiles, state)
+
+def reparse_changed_tiles(session, army_id, flat_tiles, game_info):
+    """session's state updated to flat_tiles, or None if this needs a full parse: a new
+    army or map, a tilemap payload, comments, or tiles that moved or changed terrain."""
+    if (session is None or session.army_id != army_id or '__tilemap' in game_info or
+            len(flat_tiles) != len(session.raw_tiles)):
+        return None
+    changed = [(tile, old) for tile, old in zip(flat_tiles, session.raw_tiles) if tile != old]
+    for tile, old in changed:
+        if (any(key.startswith('__') for key in list(tile) + list(old)) or
+                [tile.get(fld) for fld in ['x_coordinate', 'y_coordinate', 'terrain_name']] !=
+                [old.get(fld) for fld in ['x_coordinate', 'y_coordinate', 'terrain_name']]):
+            return None
+    state = session.state
+    for tile in state.tiles_by_idx.values():
+        for fld in SCRATCH_TILE_FIELDS:
+            tile.pop(fld, None)
+    for tile, _ in changed:
+        tile = set_xy_fields(tile)
+        state.tiles_by_idx[tile['xyidx']] = tile
+        state.board.update_tile(tile)
+    parse_tiles_by_idx(state)
+    trace(DBG_PARSE_TIMING, 'session: re-parsed {} of {} tiles', len(changed), len(flat_tiles))
+    return state
+
+def choose_move(state, player_id, game_info, players, rng, deadline=None):
+    """enumerates, scores and picks one move for state's board.  returns (move,
+    number of moves found, number of them scored before the deadline)."""
+    phase_start = time.perf_counter()
+    unmoved_tiles = [unit for unit in (state.my_units + state.my_castles)
+                     if unit.get('moved') != '1']
+    # don't parallelize end_turn, nor boards too small to repay the pickling
+    if PARALLEL_MOVE_DISCOVERY and len(unmoved_tiles) >= max(1, PARALLEL_MIN_TILES):
+        moves = discover_moves_parallel(state, player_id, players, unmoved_tiles, deadline)
     else:
-        moves = enumerate_all_moves_trapped(player_id, army_id, game_info, players)
+        moves = enumerate_all_moves_trapped(state, player_id, game_info, players,
+                                            split_deadline(deadline))
+    phase_start = observe_phase('enumerate', phase_start)
 
     sum_scores = 0.0
     min_score = 999999999
@@ -1051,12 +1977,12 @@ def select_next_move(player_id, game_info, preparsed=False):
         for mvkey in list(moves.keys()):
             if moves[mvkey]['data']['end_turn']:
                 del moves[mvkey]
-    for mvkey, move in moves.items():
-        if '__score' not in move:
-            move['__score'], move['__score_pos'], move['__score_details'] = score_move(
-                army_id, TILES_BY_IDX, player_info, move)
-        sum_scores += move['__score']
-        min_score = min(min_score, move['__score'])
+    num_found = len(moves)
+    # summed in move order, exactly as when each move was scored in this loop
+    for score in score_moves(state, players[player_id], moves, deadline).tolist():
+        sum_scores += score
+        min_score = min(min_score, score)
+    phase_start = observe_phase('score', phase_start)
     sum_scores -= min_score * len(moves)
     sum_top_scores_wt = 0.0
     # pick from the top N moves, to avoid a herd of mediocre moves from competing
@@ -1070,9 +1996,11 @@ def select_next_move(player_id, game_info, preparsed=False):
         if mvkey in top_moves_keys:
             sum_top_scores_wt += move['__score_wt']
 
+    # choose by index: move keys are tuples, which numpy would turn into a 2-D array
     movekeys = list(top_moves.keys())
-    mvkey = numpy.random.choice(   # pylint:disable=E1101
-        movekeys, p=[top_moves[movekey]['__score_wt'] / sum_top_scores_wt for movekey in movekeys])
+    mvkey = movekeys[rng.choice(
+        len(movekeys), p=[top_moves[movekey]['__score_wt'] / sum_top_scores_wt
+                          for movekey in movekeys])]
     if DBG_MOVES:
         sorted_moves = sorted(moves.keys(), key=lambda mvkey: moves[mvkey]['__score'],
                               reverse=True)
@@ -1082,18 +2010,163 @@ def select_next_move(player_id, game_info, preparsed=False):
                 ) for key in sorted_moves])
         ))
     if len(moves) == 1:
-        DBGPRINT("board:\n" + combined_map(tiles_list, army_id))
-    move = moves[mvkey]
+        trace(DBG_BOARD, "board:\n{}", functools.partial(
+            combined_map, state.tiles_by_idx.values(), state.army_id))
+    observe_phase('select', phase_start)
+    CANDIDATE_MOVES.observe(num_found, ('found',))
+    CANDIDATE_MOVES.observe(len(moves), ('evaluated',))
+    return moves[mvkey], num_found, len(moves)
+
+#---------------------------------------------------------------------------
+# turn planning (PLAN_TURNS): the first request of a turn chooses every move of the
+# turn, applying each one to the board before choosing the next.  each step of the
+# plan stores the board it expects, and later requests whose board matches are
+# answered from the plan.  e.g. a different combat outcome or a unit revealed
+# from fog means a mismatch, and the rest of the turn is replanned.
+#
 
-    LAST_MOVES[game_id] = move
-    total_time = datetime.datetime.now() - start_time
-    if DBG_TIMING:
-        DBGPRINT('total response time: {}'.format(msec(total_time)))
+# tile fields which apply_move changes, except those it fills with placeholders
+# (unit ids and names, fuel, ammo) that the game server sets to its own values.
+# unit fields only count where there's a unit: empty tiles carry default values.
+PLAN_BLDG_FIELDS = ['building_army_id', 'capture_remaining']
+PLAN_UNIT_FIELDS = ['unit_army_id', 'unit_name', 'health', 'moved',
+                    'slot1_deployed_unit_name', 'slot1_deployed_unit_health']
+
+def board_fingerprint(state, player_info):
+    """summary of the board as far as plans are concerned: funds, and per tile (in
+    xyidx order), whether it's in fog, its building fields and its unit fields."""
+    def fields(tile, flds):
+        return tuple('' if tile.get(fld) is None else str(tile[fld]) for fld in flds)
+    return (str(int(player_info.get('funds') or 0)),
+            [(tile.get('in_fog') == '1', fields(tile, PLAN_BLDG_FIELDS),
+              fields(tile, PLAN_UNIT_FIELDS) if has_army_unit(tile) else ())
+             for _, tile in sorted(state.tiles_by_idx.items())])
+
+def same_board(expected, actual):
+    """whether the actual board_fingerprint is what a plan step expects.  fog is the
+    exception: plans don't predict it, so tiles fogged now are skipped, and for tiles
+    revealed since planning, only the units are compared."""
+    if expected[0] != actual[0] or len(expected[1]) != len(actual[1]):
+        return False
+    for (exp_fog, exp_bldg, exp_unit), (fog, bldg, unit) in zip(expected[1], actual[1]):
+        if not fog and (unit != exp_unit or (bldg != exp_bldg and not exp_fog)):
+            return False
+    return True
+
+def update_board(state, journal):
+    """re-encodes the tiles in journal (see apply_move) and rebuilds the unit lists."""
+    for tile in dict((id(mydict), mydict) for mydict, _, _ in journal
+                     if 'xyidx' in mydict).values():
+        state.board.update_tile(tile)
+    parse_tiles_by_idx(state)
+
+def plan_turn(state, player_id, game_info, rng, deadline=None):
+    """chooses the moves for the rest of the turn, as a list of (board_fingerprint,
+    move, num_found, num_evaluated), ending with end_turn unless cut short by the
+    deadline.  state is unchanged on return."""
+    players = copy.deepcopy(game_info['players'])
+    player_info = players[player_id]
+    journal, plan = [], []
+    for _ in range(len(state.tiles_by_idx)):
+        if len(plan) > 0 and past_deadline(deadline):
+            break
+        fingerprint = board_fingerprint(state, player_info)
+        move, num_found, num_evaluated = choose_move(
+            state, player_id, game_info, players, rng, deadline)
+        # only the first move is needed now; the others mustn't be worse for planning
+        if len(plan) > 0 and num_evaluated < num_found:
+            break
+        plan.append((fingerprint, move, num_found, num_evaluated))
+        num_changes = len(journal)
+        if not apply_move(state.army_id, state.tiles_by_idx, player_info, move,
+                          journal=journal):
+            break
+        update_board(state, journal[num_changes:])
+    changes = list(journal)
+    rollback_move(journal)
+    update_board(state, changes)
+    trace(DBG_MOVES, "planned {} moves", len(plan))
+    return plan
+
+def planned_move(game, state, player_id, game_info, rng, deadline=None):
+    """the next move of the plan in game (the game's GAMES entry) if state is the
+    board it expects, otherwise the first move of a new plan.  returns (move,
+    num_found, num_evaluated, hit)."""
+    plan = game.get('plan')
+    hit = (plan is not None and plan['army_id'] == state.army_id and
+           len(plan['steps']) > 0 and same_board(
+               plan['steps'][0][0], board_fingerprint(state, game_info['players'][player_id])))
+    if not hit:
+        plan = game['plan'] = {
+            'army_id': state.army_id,
+            'steps': plan_turn(state, player_id, game_info, rng, deadline) }
+    _, move, num_found, num_evaluated = plan['steps'].pop(0)
+    return move, num_found, num_evaluated, hit
+
+def select_next_move(player_id, game_info, state=None, rng=None, deadline=None,
+                     decorate=True):
+    """state is the parsed board (see parse_map); None to parse game_info, or with
+    SESSION_CACHE, to update the game's session.  rng defaults to the global
+    numpy.random, see new_rng().  deadline (see response_deadline) defaults to
+    MAX_RESPONSE_MSEC from now; past it, the best move found so far is returned.
+    decorate=False skips the __maps and __stats debugging aids."""
+    if deadline is None:
+        deadline = response_deadline()
+    if DBG_PRINT_SHORTCODES:
+        DBGPRINT("\n".join(["{}: {}".format(name, typ) for name, typ in
+                            sorted(TERRAIN_SHORTCODES.items())]))
+        DBGPRINT("\n".join(["{}: {}".format(name, typ) for name, typ in
+                            sorted(UNIT_SHORTCODES.items())]))
+    start_time = time.perf_counter()
+
+    game_id = game_info['game_id']
+    game = GAMES.get(game_id, {})
+    # save the request, for replay (low level debugging)
+    if DEBUG:
+        dump_request(game_id, player_id, game_info)
+
+    tiles, players = game_info['tiles'], game_info['players']
+    player_info = players[player_id]
+    army_id = player_info['army_id']
+    session = None
+    if state is None:
+        parse_start = time.perf_counter()
+        if SESSION_CACHE:
+            state, session = session_state(game, army_id, tiles, game_info)
+        else:
+            state = parse_map(army_id, tiles, game_info)
+        parse_time = time.perf_counter() - parse_start
+        PHASE_SECONDS.observe(parse_time, ('parse',))
+        trace(DBG_PARSE_TIMING, 'parse time: {}', msec(parse_time))
+    if rng is None:
+        rng = numpy.random
+    tiles_list = state.tiles_by_idx.values()
+    if DBG_BOARD and is_first_move_in_turn(game_info['game_id']):
+        trace(DBG_BOARD, "board:\n{}", functools.partial(combined_map, tiles_list, army_id))
+    plan_hit = False
+    if PLAN_TURNS:
+        move, num_found, num_evaluated, plan_hit = planned_move(
+            game, state, player_id, game_info, rng, deadline)
+    else:
+        move, num_found, num_evaluated = choose_move(
+            state, player_id, game_info, players, rng, deadline)
+
+    LAST_MOVES.put(game_id, {'data': move['data']})
+    if session is not None:
+        game['session'] = session
+    GAMES.put(game_id, game)
+    total_time = time.perf_counter() - start_time
+    trace(DBG_TIMING, 'total response time: {}', msec(total_time))
+    if not decorate:
+        return move
     # compact response helps debugging
     move['__maps'] = { 'move': movemap_list(tiles_list, army_id, move),
                        'tile': tilemap_list(tiles_list) }
-    move['__stats'] = { 'possible_moves': len(moves),
+    move['__stats'] = { 'possible_moves': num_found,
+                        'evaluated_moves': num_evaluated,
                         'response_msec': msec(total_time) }
+    if PLAN_TURNS:
+        move['__stats']['from_plan'] = plan_hit
     return move
 
 def player_units(army_id, tiles_by_idx):
@@ -1102,17 +2175,16 @@ def player_units(army_id, tiles_by_idx):
 def player_bldgs(army_id, tiles_by_idx):
     return [tile for tile in tiles_by_idx.values() if tile.get('building_army_id') == army_id]
 
-def set_fog_values(army_id, tiles_by_idx):
-    my_units = player_units(army_id, tiles_by_idx)
+def set_fog_values(state):
+    army_id, tiles_by_idx = state.army_id, state.tiles_by_idx
     my_bldgs = player_bldgs(army_id, tiles_by_idx)
+    visible = state.vision_grid.viewer_counts(player_units(army_id, tiles_by_idx)) > 0
     num_visible = 0
     for tile in tiles_by_idx.values():
         tile['in_fog'] = "1"
-        for unit in my_units:
-            if is_visible(unit, tile):
-                num_visible += 1
-                tile['in_fog'] = "0"
-                break
+        if visible[tile['y'], tile['x']]:
+            num_visible += 1
+            tile['in_fog'] = "0"
         if tile['in_fog'] == "1":
             newtile = dict( (key, val) for key, val in tile.items() if key in [
                 'xy', 'xystr', 'xyidx', 'x_coordinate', 'y_coordinate', 'x', 'y',
@@ -1123,6 +2195,11 @@ def set_fog_values(army_id, tiles_by_idx):
         tile['in_fog'] = "0"
     return num_visible
 
+def count_visible(state):
+    """the num_visible that set_fog_values returns, without fogging any tiles."""
+    return state.vision_grid.num_visible(state.vision_grid.viewer_counts(
+        player_units(state.army_id, state.tiles_by_idx)))
+
 def new_funds(army_id, tiles_by_idx):
     return len([unit for unit in player_bldgs(army_id, tiles_by_idx) if
                 unit['terrain_name'] in CAPTURABLE_TERRAIN]) * 1000
@@ -1141,33 +2218,57 @@ def compute_damage(attacker, defender):
     terrain_weight = 1.0 - (TERRAIN_DEFENSE[defender['terrain_name']] / 10.0)
     return max(1, int(base_damage * attack_weight * terrain_weight))
 
-def apply_move(army_id, tiles_by_idx, player_info, move, dbg=False):
+JOURNAL_MISSING = object()   # journal marker: the key didn't exist before the change
+
+def rollback_move(journal):
+    """undo the board/player_info changes recorded by apply_move(..., journal=journal),
+    newest first.  leaves the journal empty, ready for reuse."""
+    while journal:
+        mydict, key, val = journal.pop()
+        if val is JOURNAL_MISSING:
+            del mydict[key]
+        else:
+            mydict[key] = val
+
+def apply_move(army_id, tiles_by_idx, player_info, move, dbg=False, journal=None):
     """added to library, so it can be used for forecasting.
     note: in forecasting mode, unfogging doesn't reveal enemy troops.
+    if journal (a list) is given, every change to tiles_by_idx and player_info is
+    recorded so rollback_move() can restore them exactly.
     returns False if the move is end_turn."""
     def mverr(msg):
         DBGPRINT("ERROR!  "+msg)
+    def set_val(mydict, key, val):
+        if journal is not None:
+            journal.append((mydict, key, mydict.get(key, JOURNAL_MISSING)))
+        mydict[key] = val
+    def del_key(mydict, key):
+        if journal is not None:
+            journal.append((mydict, key, mydict[key]))
+        del mydict[key]
     def update_tile_with_dict(tile, update_dict):
-        tiles_by_idx[tile['xyidx']].update(update_dict)
+        tile = tiles_by_idx[tile['xyidx']]
+        for key, val in update_dict.items():
+            set_val(tile, key, val)
     def update_tile_with_unit(tile, unit):
         update_tile_with_dict(tile, dict( (key,val) for key,val in unit.items()
                                           if key in UNIT_DICT_KEYS))
     def del_unit(tile):
         for key in list(tile.keys()):  # copy to avoid chging during iter
             if key in UNIT_DICT_KEYS:
-                del tile[key]
+                del_key(tile, key)
     def del_loaded_unit(tile):
-        del tile['slot1_deployed_unit_id']
-        del tile['slot1_deployed_unit_name']
-        del tile['slot1_deployed_unit_health']
+        del_key(tile, 'slot1_deployed_unit_id')
+        del_key(tile, 'slot1_deployed_unit_name')
+        del_key(tile, 'slot1_deployed_unit_health')
     def move_unit(src_tile, dest_tile):
-        src_tile['moved'] = '1'
+        set_val(src_tile, 'moved', '1')
         if src_tile['xyidx'] == dest_tile['xyidx']: return
         update_tile_with_unit(dest_tile, src_tile)
         del_unit(src_tile)
         if can_capture(dest_tile, src_tile, dest_tile['unit_army_id']):
             # undo partial capture
-            src_tile['capture_remaining'] = "20"
+            set_val(src_tile, 'capture_remaining', "20")
 
     #DBGPRINT("move={}".format(move))
     if move.get('stop_worker_num', '') != '':
@@ -1186,7 +2287,8 @@ def apply_move(army_id, tiles_by_idx, player_info, move, dbg=False):
         if int(player_info['funds']) < UNIT_TYPES[unit_name]['cost']:
             return mverr('insufficient funds {} to purchase a {} (cost={}) at {}'.format(
                 player_info['funds'], unit_name, UNIT_TYPES[unit_name]['cost'], tilestr(castle)))
-        player_info['funds'] = str(int(player_info['funds']) - UNIT_TYPES[unit_name]['cost'])
+        set_val(player_info, 'funds',
+                str(int(player_info['funds']) - UNIT_TYPES[unit_name]['cost']))
         new_unit_id = 100 + \
             max([int(ifdictnone(tile, 'unit_id', 0)) for tile in tiles_by_idx.values()])
         update_tile_with_dict(castle, {
@@ -1256,7 +2358,7 @@ def apply_move(army_id, tiles_by_idx, player_info, move, dbg=False):
         if is_loaded_unicorn(dest_tile) or  is_loaded_skateboard(dest_tile):
             return mverr("attempted to join to Unicorn that's already loaded: {}".format(
                 dest_tile['unit_name'], tilestr(dest_tile, True)))
-        dest_tile['health'] = min(unit_health(dest_tile) + unit_health(src_tile), 100)
+        set_val(dest_tile, 'health', min(unit_health(dest_tile) + unit_health(src_tile), 100))
         del_unit(src_tile)
         return True
 
@@ -1270,13 +2372,13 @@ def apply_move(army_id, tiles_by_idx, player_info, move, dbg=False):
         capture_remaining = get_capture_remaining(dest_tile)
         capture_remaining = max(0, int(capture_remaining) - int(10.0 * unit_health(src_tile) / 100.0))
         move_unit(src_tile, dest_tile)
-        dest_tile.update({ 'capture_remaining': str(capture_remaining) })
+        update_tile_with_dict(dest_tile, { 'capture_remaining': str(capture_remaining) })
         if capture_remaining == 0:
             if dbg: DBGPRINT('army_id={} completed capture of {}'.format(army_id, tilestr(dest_tile)))
-            dest_tile.update({ 'building_army_id': army_id,
-                               'capture_remaining': '20', # reset
-                               'building_army_name': "TODOarmy_name",
-                               'building_team_name': "TODOteam_name" })
+            update_tile_with_dict(dest_tile, { 'building_army_id': army_id,
+                                               'capture_remaining': '20', # reset
+                                               'building_army_name': "TODOarmy_name",
+                                               'building_team_name': "TODOteam_name" })
         else:
             if dbg: DBGPRINT('army_id={} capturing {}, capture_remaining={}'.format(
                 army_id, tilestr(dest_tile), capture_remaining))
@@ -1304,7 +2406,7 @@ def apply_move(army_id, tiles_by_idx, player_info, move, dbg=False):
         move['__attack'] = {'attacker':tilestr(attacker), 'attacker_health': attacker['health'],
                             'defender': tilestr(defender), 'defender_health': defender['health'],
                             'damage': damage }
-        defender['health'] = str(unit_health(defender) - damage)
+        set_val(defender, 'health', str(unit_health(defender) - damage))
         rdamage = 0
         if unit_health(defender) <= 0:
             del_unit(defender)
@@ -1315,7 +2417,7 @@ def apply_move(army_id, tiles_by_idx, player_info, move, dbg=False):
             move['__attack']['return_damage'] = rdamage
             if dbg: DBGPRINT('=> return dmg={} vs attacker health={}'.format(
                     rdamage, attacker['health']))
-            attacker['health'] = str(unit_health(defender) - rdamage)
+            set_val(attacker, 'health', str(unit_health(defender) - rdamage))
             if unit_health(attacker) <= 0:
                 move['__killed_atk'] = copy.deepcopy(attacker)
                 del_unit(attacker)
@@ -1329,34 +2431,56 @@ def apply_move(army_id, tiles_by_idx, player_info, move, dbg=False):
                 army_id, tilestr(src_tile), tilestr(dest_tile)))
         move_unit(src_tile, dest_tile)
     else:
-        src_tile['moved'] = '1'
+        set_val(src_tile, 'moved', '1')
     return True
 
 def attack_strength(unit):
     return ATTACK_STRENGTH[unit['unit_name']] * unit_health(unit) / 100.0
 
-def score_position(army_id, tiles_by_idx, move=None):
+def position_tiles(army_id, tiles_by_idx):
+    """my units, castles and towns, found the same way as parse_tiles_by_idx but
+    without touching the globals, so scoring can't clobber the parsed board."""
+    my_units, my_castles, my_towns = [], [], []
+    for tile in tiles_by_idx.values():
+        if has_army_unit(tile) and tile['unit_army_id'] == army_id:
+            my_units.append(tile)
+        if tile['terrain_name'] == 'Castle' and is_my_building(tile, army_id):
+            my_castles.append(tile)
+        elif tile['terrain_name'] == 'Town' and is_my_building(tile, army_id):
+            my_towns.append(tile)
+    return my_units, my_castles, my_towns
+
+def score_position(state, move=None, num_visible=None):
+    """read-only: safe to call between apply_move(..., journal) and rollback_move.
+    num_visible defaults to count_visible()."""
+    army_id, tiles_by_idx = state.army_id, state.tiles_by_idx
     # TODO: capture in progress and units that can't finish capture bec of attacks
     # TODO: Enemy has less visibility -- also accounts for pushing back
     # TODO: Special bonus for trying to capture castles and enemy hq
-    parse_tiles_by_idx(army_id, tiles_by_idx)
-    num_visible = set_fog_values(army_id, tiles_by_idx)
+    my_units, my_castles, my_towns = position_tiles(army_id, tiles_by_idx)
+    if num_visible is None:
+        num_visible = count_visible(state)
     # More board visible (less fog) -- also accounts for moving to 'front line'
     pct_visible = int((100.0 * num_visible) / len(tiles_by_idx))
-    production_capacity = len(MY_CASTLES) + len(MY_TOWNS)
+    production_capacity = len(my_castles) + len(my_towns)
     # encourage units to move away from castles
     dist_from_my_castles = 0
-    for unit in MY_UNITS:
-        for castle in MY_CASTLES:
+    for unit in my_units:
+        for castle in my_castles:
             dist_from_my_castles += dist(unit, castle)
-    if len(MY_UNITS) > 0:
-        dist_from_my_castles /= float(len(MY_UNITS))
-    num_my_units = len(MY_UNITS)
+    if len(my_units) > 0:
+        dist_from_my_castles /= float(len(my_units))
+    num_my_units = len(my_units)
     # scale to assuming 10 units before overwhelming other factors
     sum_attack_strength = int(sum([attack_strength(unit)*unit_health(unit)/1000.0
-                                   for unit in MY_UNITS]))
+                                   for unit in my_units]))
     sum_unit_health = int(sum([unit_health(unit)/100.0
-                                    for unit in MY_UNITS]))
+                                    for unit in my_units]))
+    return position_score(num_my_units, production_capacity, pct_visible,
+                          sum_attack_strength, sum_unit_health, dist_from_my_castles, move)
+
+def position_score(num_my_units, production_capacity, pct_visible,
+                   sum_attack_strength, sum_unit_health, dist_from_my_castles, move=None):
     # square the score to skew move choice to better moves...
     score = num_my_units * 10 + production_capacity * 10 + pct_visible + \
             sum_attack_strength + sum_unit_health + dist_from_my_castles * 40.0
@@ -1367,22 +2491,91 @@ def score_position(army_id, tiles_by_idx, move=None):
                movestr(move) if move else "") if DBG_SCORING else ""
     return score, msg
 
+class PositionScorer(object):
+    """score_position for many candidate moves on one board.  the position terms are
+    computed once; each candidate then re-derives just the tiles its apply_move
+    journal touched.  float terms are still summed in tile order, like
+    score_position, so scores match it bit for bit."""
+    def __init__(self, state):
+        army_id, tiles_by_idx = state.army_id, state.tiles_by_idx
+        self.army_id, self.num_tiles = army_id, len(tiles_by_idx)
+        self.rank = dict([(xyidx, rank) for rank, xyidx in enumerate(tiles_by_idx.keys())])
+        my_units, my_castles, my_towns = position_tiles(army_id, tiles_by_idx)
+        self.castles = dict([(tile['xyidx'], (tile['x'], tile['y'])) for tile in my_castles])
+        self.towns = set([tile['xyidx'] for tile in my_towns])
+        self.units = dict([(unit['xyidx'], self.unit_terms(unit, self.castles))
+                           for unit in my_units])
+        self.vision = ArmyVision(state)
+        # score_move's targets are taken before the move, i.e. the same for every candidate
+        if state.template is not None:
+            capturable = [tiles_by_idx[xyidx] for xyidx in state.template.capturable]
+        else:
+            capturable = [tile for tile in tiles_by_idx.values()
+                          if tile['terrain_name'] in CAPTURABLE_TERRAIN]
+        self.capturable_tiles = [tile for tile in capturable
+                                 if tile.get('building_army_id') != army_id]
+        self.attackable_units = [tile for tile in tiles_by_idx.values() if
+                                 tile.get('unit_army_id') not in [None, army_id]]
+
+    @staticmethod
+    def unit_terms(unit, castles):
+        """(attack, health, castle distance) terms of score_position for one unit."""
+        return (attack_strength(unit)*unit_health(unit)/1000.0, unit_health(unit)/100.0,
+                sum([abs(cx - unit['x']) + abs(cy - unit['y']) for cx, cy in castles.values()]))
+
+    def score_position(self, journal, move=None):
+        """score_position(state, move) for the board as left by
+        apply_move(..., journal=journal)."""
+        army_id, units, castles, towns = self.army_id, self.units, self.castles, self.towns
+        touched = dict([(mydict['xyidx'], mydict) for mydict, _, _ in journal
+                        if 'xyidx' in mydict])
+        if touched:
+            units, castles, towns = dict(units), dict(castles), set(towns)
+            for xyidx, tile in touched.items():
+                castles.pop(xyidx, None)
+                towns.discard(xyidx)
+                units.pop(xyidx, None)
+                if tile['terrain_name'] == 'Castle' and is_my_building(tile, army_id):
+                    castles[xyidx] = (tile['x'], tile['y'])
+                elif tile['terrain_name'] == 'Town' and is_my_building(tile, army_id):
+                    towns.add(xyidx)
+            if castles.keys() != self.castles.keys():
+                # captured a castle: every unit's castle distance changes
+                for xyidx, terms in list(units.items()):
+                    units[xyidx] = terms[:2] + (sum(
+                        [abs(cx - xyidx % 1000) + abs(cy - xyidx // 1000)
+                         for cx, cy in castles.values()]),)
+            for xyidx, tile in touched.items():
+                if has_army_unit(tile) and tile['unit_army_id'] == army_id:
+                    units[xyidx] = self.unit_terms(tile, castles)
+        terms = [units[xyidx] for xyidx in sorted(units, key=self.rank.__getitem__)]
+        pct_visible = int((100.0 * self.vision.num_visible(journal)) / self.num_tiles)
+        dist_from_my_castles = 0
+        for term in terms:
+            dist_from_my_castles += term[2]
+        if len(terms) > 0:
+            dist_from_my_castles /= float(len(terms))
+        return position_score(len(terms), len(castles) + len(towns), pct_visible,
+                              int(sum([term[0] for term in terms])),
+                              int(sum([term[1] for term in terms])),
+                              dist_from_my_castles, move)
+
     
-def score_move(army_id, tiles_by_idx, player_info, move):
+def score_move(state, player_info, move, scorer=None, attack=None):
+    """scores move by applying it to state's tiles and rolling it back afterwards,
+    i.e. the tiles and player_info are unchanged on return.  to score many moves
+    on one board, use score_moves()."""
     if move.get('stop_worker_num', '') != '':
         return 0, 0, ""
-    tiles_by_idx = copy.deepcopy(tiles_by_idx)
-    player_info = copy.deepcopy(player_info)
 
+    army_id, tiles_by_idx = state.army_id, state.tiles_by_idx
+    if scorer is None:
+        scorer = PositionScorer(state)
     # TODO: detect HQ capture - this is just to avoid divide-by-zero errors
-    capturable_tiles = [tile for tile in tiles_by_idx.values()
-                        if tile['terrain_name'] in CAPTURABLE_TERRAIN
-                        and tile.get('building_army_id') != army_id]
-    attackable_units = [tile for tile in tiles_by_idx.values() if
-                        tile.get('unit_army_id') not in [None, army_id]]
+    capturable_tiles, attackable_units = scorer.capturable_tiles, scorer.attackable_units
     if len(capturable_tiles) == 0:
         print("WINNER!  nothing left to capture.  army_id={}".format(army_id))
-        sys.exit(0)
+        raise GameOver(army_id)
     
     # very basic algorithm -- subtly, these rules increase game speed by reducing the search space
     # - preferring moves which attack nearby enemies
@@ -1398,7 +2591,7 @@ def score_move(army_id, tiles_by_idx, player_info, move):
         if 'x_coord_attack' in movemove:
             defender_xyidx = int(movemove['y_coord_attack'])*1000 + int(movemove['x_coord_attack'])
             defender = tiles_by_idx[defender_xyidx]
-            damage = compute_damage(dest_tile, defender)
+            damage = compute_damage(dest_tile, defender) if attack is None else attack[0]
             # scale bonus for more damage, which also means they do less damage to us
             num_turns_to_kill = min(4, int(unit_health(defender) / damage))
             multiplier *= {0:4.0, 1:2.0, 2:1.25, 3:0.5, 4:0.25}[num_turns_to_kill]
@@ -1425,17 +2618,49 @@ def score_move(army_id, tiles_by_idx, player_info, move):
                 ", ".join(['{}@{}'.format(val, xyidxstr(key)) for key,val in top3dist])))
         multiplier *= (1.0 + (0.8/avg_dist))
 
-    res = apply_move(army_id, tiles_by_idx, player_info, move)
+    journal = []
+    res = apply_move(army_id, tiles_by_idx, player_info, move, journal=journal)
     if res is None:
+        rollback_move(journal)
         DBGPRINT("bad move {}: skipping...".format(move))
         return 0, 0, ""
-    pos_score, msg = score_position(army_id, tiles_by_idx, move)
+    pos_score, msg = scorer.score_position(journal, move)
+    rollback_move(journal)
     # note that purchase gets the lowest score, with a base of 0.0 i.e. it comes last
     score = multiplier * pos_score
     if DBG_SCORING:
         msg = "score: {:.2f} = mult({:.2f}) * base={}".format(score, multiplier, msg)
     return score, pos_score, msg
 
+def score_moves(state, player_info, moves, deadline=None):
+    """score_move for every move in moves (see cache_move) not scored yet, sharing
+    one PositionScorer and one resolve_attack_moves() pass.  sets each move's
+    __score, __score_pos and __score_details; returns the scores as a numpy
+    vector, in moves order.  with a deadline, moves are scored in MOVE_KIND_PRIORITY
+    order and those not scored in time are dropped from moves (at least one is kept)."""
+    scorer = None
+    order = list(moves.keys())
+    if deadline is not None:
+        order.sort(key=lambda mvkey: MOVE_KIND_PRIORITY.index(mvkey[0]))
+    num_scored = 0
+    for mvkey in order:
+        move = moves[mvkey]
+        if '__score' in move:
+            num_scored += 1
+            continue
+        if num_scored > 0 and past_deadline(deadline):
+            break
+        if scorer is None:
+            scorer = PositionScorer(state)
+            attacks = resolve_attack_moves(state.tiles_by_idx, moves)
+        move['__score'], move['__score_pos'], move['__score_details'] = score_move(
+            state, player_info, move, scorer, attacks.get(mvkey))
+        num_scored += 1
+    for mvkey in order[num_scored:]:
+        if '__score' not in moves[mvkey]:
+            del moves[mvkey]
+    return numpy.array([move['__score'] for move in moves.values()], dtype=float)
+
 def initialize_player_turn(army_id, tiles_by_idx, player_info, game_state):
     game_state['botPlayerId'] = int(player_info['player_id'])
     player_info['funds'] = int(player_info.get('funds', 0)) + new_funds(army_id, tiles_by_idx)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#
+# bench.py - getNextMove latency/throughput benchmark
+#
+# replays fixtures against select_next_move in-process, or against the HTTP server,
+# and writes the results as JSON for comparing commits.  e.g.
+#   ./bench.py
+#   BENCH_MODE=http BENCH_CONCURRENCY=4 ./bench.py test_forest_full.json
+#   BENCH_MODE=http BENCH_URL=http://localhost:5000/meatshields/bot/getNextMove ./bench.py
+#
+# without BENCH_URL, http mode serves basicbot.py from a thread of this process,
+# so everything runs offline.
+#
+import sys, os, json, time, glob, resource, subprocess, threading, logging
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import basicbot_lib as bblib
+
+BENCH_MODE = os.environ.get('BENCH_MODE', 'inprocess')   # or http
+BENCH_URL = os.environ.get('BENCH_URL', '')
+BENCH_CONCURRENCY = int(os.environ.get('BENCH_CONCURRENCY', '1'))
+BENCH_REQUESTS = int(os.environ.get('BENCH_REQUESTS', '50'))     # per fixture
+BENCH_WARMUP = int(os.environ.get('BENCH_WARMUP', '3'))          # per fixture, not timed
+# 1: every request gets its own game_id, i.e. a full parse; 0: replay the fixture's
+# game_id, so requests after the first reuse the game's session
+BENCH_FRESH_GAMES = (os.environ.get('BENCH_FRESH_GAMES', '1') == '1')
+BENCH_OUTPUT = os.environ.get('BENCH_OUTPUT', '')
+BENCH_VERBOSE = (os.environ.get('BENCH_VERBOSE', '0') == '1')
+
+DEFAULT_FIXTURES = (['example_getNextMove.json', 'test_attacking.json',
+                     'test_forest_full.json'] + sorted(glob.glob('example_2p_*.json')))
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def peak_rss_mb():
+    # ru_maxrss is KB on linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(maxrss / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+def percentiles(msecs):
+    if len(msecs) == 0:
+        return {}
+    return { 'requests': len(msecs), 'mean_msec': round(float(numpy.mean(msecs)), 3),
+             'p50_msec': round(float(numpy.percentile(msecs, 50)), 3),
+             'p95_msec': round(float(numpy.percentile(msecs, 95)), 3),
+             'p99_msec': round(float(numpy.percentile(msecs, 99)), 3),
+             'max_msec': round(float(numpy.max(msecs)), 3) }
+
+def request_body(fixture_json, reqnum):
+    """the fixture's request, with a game_id of its own if BENCH_FRESH_GAMES."""
+    jsondata = json.loads(fixture_json)
+    if BENCH_FRESH_GAMES:
+        jsondata['gameInfo']['game_id'] = 'bench-{}'.format(reqnum)
+    return jsondata
+
+def inprocess_request(fixture_json, reqnum):
+    jsondata = request_body(fixture_json, reqnum)
+    player_id = str(jsondata['botPlayerId'])
+    rng = bblib.new_rng(bblib.DBG_RAND_SEED + reqnum)
+    start = time.perf_counter()
+    bblib.select_next_move(player_id, jsondata['gameInfo'], rng=rng, decorate=False)
+    return time.perf_counter() - start
+
+def http_request(fixture_json, reqnum):
+    data = json.dumps(request_body(fixture_json, reqnum)).encode('utf-8')
+    req = urllib.request.Request(BENCH_URL, data=data,
+                                 headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    with urllib.request.urlopen(req) as resp:
+        resp.read()
+    return time.perf_counter() - start
+
+def evaluated_candidates():
+    """total moves scored so far, from the in-process or the server's metrics."""
+    if BENCH_MODE == 'inprocess':
+        metrics_text = bblib.metrics_text()
+    else:
+        metrics_url = BENCH_URL.rsplit('/', 1)[0] + '/getMetrics'
+        with urllib.request.urlopen(metrics_url) as resp:
+            metrics_text = resp.read().decode('utf-8')
+    for line in metrics_text.splitlines():
+        if line.startswith('bot_candidate_moves_sum{stage="evaluated"}'):
+            return float(line.split()[-1])
+    return 0.0
+
+def start_local_server():
+    """serves basicbot.py on a free localhost port, from a daemon thread."""
+    from werkzeug.serving import make_server
+    import basicbot
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    # replayed fixtures would be answered from the response cache, not computed
+    bblib.RESPONSE_CACHE_SIZE = 0
+    server = make_server('127.0.0.1', 0, basicbot.APP, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}/meatshields/bot/getNextMove'.format(server.server_port)
+
+def main():
+    global BENCH_URL
+    fixtures = sys.argv[1:] or DEFAULT_FIXTURES
+    if not BENCH_VERBOSE:
+        bblib.DBGPRINT = lambda msg: None
+    bblib.set_random_seed()
+    if BENCH_MODE == 'http' and BENCH_URL == '':
+        BENCH_URL = start_local_server()
+    do_request = http_request if BENCH_MODE == 'http' else inprocess_request
+    fixture_jsons = dict((fixture, open(fixture).read()) for fixture in fixtures)
+
+    # warm up caches/imports, then time every fixture's requests interleaved
+    for fixture in fixtures:
+        for reqnum in range(BENCH_WARMUP):
+            do_request(fixture_jsons[fixture], -1 - reqnum)
+    tasks = [(fixture, reqnum) for reqnum in range(BENCH_REQUESTS) for fixture in fixtures]
+    candidates_before = evaluated_candidates()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=BENCH_CONCURRENCY) as executor:
+        secs = list(executor.map(
+            lambda reqnum: do_request(fixture_jsons[tasks[reqnum][0]], reqnum),
+            range(len(tasks))))
+    wall_secs = time.perf_counter() - start
+    candidates = evaluated_candidates() - candidates_before
+
+    msecs_by_fixture = dict((fixture, []) for fixture in fixtures)
+    for (fixture, _), sec in zip(tasks, secs):
+        msecs_by_fixture[fixture].append(sec * 1000)
+    results = {
+        'commit': git_commit(), 'timestamp': int(time.time()),
+        'mode': BENCH_MODE, 'url': BENCH_URL or None, 'concurrency': BENCH_CONCURRENCY,
+        'fresh_games': BENCH_FRESH_GAMES, 'seed': bblib.DBG_RAND_SEED,
+        'python': sys.version.split()[0],
+        'overall': percentiles([sec * 1000 for sec in secs]),
+        'requests_per_sec': round(len(tasks) / wall_secs, 2),
+        'candidates_per_sec': round(candidates / wall_secs, 1),
+        # with an external server, this is the client's RSS only
+        'peak_rss_mb': peak_rss_mb(),
+        'fixtures': dict((fixture, percentiles(msecs))
+                         for fixture, msecs in msecs_by_fixture.items()),
+    }
+    for fixture, stats in sorted(results['fixtures'].items()):
+        print("{:30s} p50 {:8.2f}ms  p95 {:8.2f}ms  p99 {:8.2f}ms".format(
+            fixture, stats['p50_msec'], stats['p95_msec'], stats['p99_msec']))
+    print("{} requests, concurrency {}: {} req/s, {} candidates/s, peak RSS {}MB".format(
+        len(tasks), BENCH_CONCURRENCY, results['requests_per_sec'],
+        results['candidates_per_sec'], results['peak_rss_mb']))
+    output = BENCH_OUTPUT or 'bench-{}-{}.json'.format(BENCH_MODE, results['commit'] or 'nogit')
+    with open(output, 'w') as output_fh:
+        json.dump(results, output_fh, indent=2, sort_keys=True)
+    print("results written to {}".format(output))
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,13 @@
 # encoding/decoding for machine learning
 #
 
-import sys, os, datetime, re, json, bz2, math
+import sys, os, datetime, json, bz2, math, struct, bisect, random, itertools, hashlib
+import numpy
 import basicbot_lib as bblib
 
 DBG_MAX_UNITS = int(os.environ.get('DBG_MAX_UNITS', '75'))
+# 'packed' (see write_board_move_state_packed) or 'text', the original ASCII bits
+BOARD_STATE_FORMAT = os.environ.get('BOARD_STATE_FORMAT', 'packed')
 
 # reserve 0 for unknown terrain & units
 def mk_terrain_types():
@@ -24,14 +27,24 @@ UNIT_VALUES = { None: 0, '': 0 }
 for unit in sorted(bblib.UNIT_TYPES.keys()):
     UNIT_VALUES[unit] = len(UNIT_VALUES)
 for carrier in ['Unicorn', 'Skateboard']:
-    for unit in bblib.LOADABLE_UNITS:
+    for unit in sorted(bblib.LOADABLE_UNITS):
         UNIT_VALUES[carrier+unit] = len(UNIT_VALUES)
 if len(UNIT_VALUES) > 32: raise Exception('more than 32 UNIT_VALUES - update the code and delete the saved games.')
 
+# the codes saved games are written with, e.g. for packed file headers and dataset
+# manifests.  CODE_TABLES_V2 pins them: the codes must be the same in every process
+# (set iteration order isn't, see PACKED_VERSION), and changing them is a new layout.
+CODE_TABLES_DIGEST = hashlib.sha1(json.dumps([
+    sorted(TERRAIN_VALUES.items()),
+    sorted([(key or '', val) for key, val in UNIT_VALUES.items()])]).encode('utf-8')).hexdigest()[:16]
+CODE_TABLES_V2 = '8d8d6aa47ff86661'
+if CODE_TABLES_DIGEST != CODE_TABLES_V2: raise Exception('terrain/unit codes changed - bump PACKED_VERSION and update CODE_TABLES_V2.')
+
 TERRAIN_NAMES = dict( [(val,key) for key,val in TERRAIN_VALUES.items()] )
 UNIT_NAMES = dict( [(val,key) for key,val in UNIT_VALUES.items()] )
 
 MOVED_STATES = { None: 0, '0': 1, '1': 2 }
+NUM_TILES = 24 * 24   # boards are encoded as this many tiles, in tiles_list order
 
 def append_unit_info(tile, done):
     if tile is None: tile = {}
@@ -74,7 +87,7 @@ def encode_board_state(army_id_turn, resigned, game_info, tiles_list, dbgloc=Non
         # TODO: augment with # towns/castles?
 
     bitmap_units = []
-    for tile_idx in range(24 * 24):
+    for tile_idx in range(NUM_TILES):
         done = (tile_idx >= len(tiles_list))
         tile = {} if done else tiles_list[tile_idx]
         # note: don't write x/y coordinates
@@ -162,39 +175,274 @@ def encode_move(move, tiles_by_idx, dbgloc=None):
     return bitmap
 
 
+# uncompressed bytes per bz2 stream: just under bz2's 900k blocks, which compress
+# independently anyway, so splitting files into streams costs next to nothing
+STREAM_BYTES = int(os.environ.get('BOARD_STATE_STREAM_BYTES', '850000'))
+
+def write_bz2_streams(filename, pieces):
+    """writes the pieces (bytes, a record each) as bz2 streams of up to STREAM_BYTES,
+    split between records.  bunzip2 and bz2.open see one file, but a reader can start
+    decompressing at any stream: see index_game_file."""
+    with open(filename, 'wb') as out_fh:
+        stream = bytearray()
+        for piece in pieces:
+            if stream and len(stream) + len(piece) > STREAM_BYTES:
+                out_fh.write(bz2.compress(bytes(stream)))
+                stream = bytearray()
+            stream += piece
+        out_fh.write(bz2.compress(bytes(stream)))
+
 def write_board_move_state(winning_army_id_str, board_move_states):
     winning_army_id = int(winning_army_id_str)
     filename = 'board-{}.txt.bz2'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
-    fh = bz2.open(filename, 'w')
+    lines = []
     for i, bitmap in enumerate(board_move_states):
         if i == 0:
             print('writing board state to {}: {} moves, {} bits each'.format(
                 filename, len(board_move_states), len(bitmap)))
         bitmap_str = "".join(bitmap)
         army_id = int(bitmap_str[0:2], 2)
-        fh.write("{}\t{}\n".format("1" if army_id == winning_army_id else "0", bitmap_str)
-                 .encode('utf-8'))
-    fh.close()
+        lines.append("{}\t{}\n".format("1" if army_id == winning_army_id else "0", bitmap_str)
+                     .encode('utf-8'))
+    write_bz2_streams(filename, lines)
 
 def write_board_move_state_json(winning_army_id_str, board_move_states_json):
     winning_army_id = int(winning_army_id_str)
     filename = 'board-{}.json.bz2'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
-    fh = bz2.open(filename, 'w')
-    maxlen = 0
-    for i, jsondata in enumerate(board_move_states_json):
-        jsondata['move_led_to_win'] = (1 if jsondata['army_id'] == winning_army_id else 0)
-        maxlen = max(maxlen, len(json.dumps(jsondata)))
+    records = []
+    for jsondata in board_move_states_json:
+        jsondata['move_led_to_win'] = (1 if int(jsondata['army_id']) == winning_army_id else 0)
+        records.append(json.dumps(jsondata))
     print('writing board state to {}: {} moves, {} max bytes, {:.0f} avg bytes'.format(
-        filename, len(board_move_states_json), maxlen,
-        1.0*len(json.dumps(board_move_states_json))/len(board_move_states_json) if
-        len(board_move_states_json) > 0 else 0))
-    fh.write(json.dumps(board_move_states_json).encode('utf-8'))
-    fh.close()
+        filename, len(records), max([len(record) for record in records] or [0]),
+        1.0 * sum([len(record) + 2 for record in records]) / len(records) if
+        len(records) > 0 else 0))
+    # the same bytes as json.dumps(board_move_states_json), split between records
+    pieces = [(', ' if i > 0 else '[') + record for i, record in enumerate(records)] or ['[']
+    pieces[-1] += ']'
+    write_bz2_streams(filename, [piece.encode('utf-8') for piece in pieces])
+
+#---------------------------------------------------------------------------
+# packed encoding: the bits of encode_board_state() + encode_move(), as a numpy
+# array of 0/1 values.  fields are gathered as numbers and turned into bits with
+# one vectorized shift, instead of a format() string per field, and files store
+# them 8 to a byte (numpy.packbits) instead of one ASCII '0'/'1' per bit.  files
+# start with PACKED_HEADER, whose version names the bit layout.  the layout is the
+# text layout, quirks included (emit_tile_loc writes x twice, the attack location
+# is only set for unloads), so the two formats convert losslessly.
+#
+
+PACKED_MAGIC = b'MSBS'
+# version 1 numbered loaded Unicorns/Skateboards in set order, which changes with
+# the process's hash seed: its files are still read, but their codes for loaded
+# carriers are unreliable.  version 2 sorts them, and its header adds the code
+# tables' digest, so files written with other codes are refused
+PACKED_VERSION = 2
+PACKED_HEADER_V1 = struct.Struct('<4sHII')   # magic, layout version, bits per record, records
+PACKED_HEADER = struct.Struct('<4sHII8s')    # the same, then CODE_TABLES_DIGEST
+
+def parse_packed_header(data):
+    """(bits per record, records, header size) from the start of a packed file."""
+    if len(data) < PACKED_HEADER_V1.size or data[:len(PACKED_MAGIC)] != PACKED_MAGIC:
+        raise ValueError('not a packed board state file')
+    _, version, num_bits, num_records = PACKED_HEADER_V1.unpack_from(data)
+    if version == 1:
+        return num_bits, num_records, PACKED_HEADER_V1.size
+    if version != PACKED_VERSION:
+        raise ValueError('bit layout version {}, expected {}'.format(version, PACKED_VERSION))
+    if len(data) < PACKED_HEADER.size:
+        raise ValueError('truncated packed board state header')
+    if PACKED_HEADER.unpack_from(data)[4] != bytes.fromhex(CODE_TABLES_DIGEST):
+        raise ValueError('written with other terrain/unit codes')
+    return num_bits, num_records, PACKED_HEADER.size
+
+# field widths, in order; see encode_move()
+MOVE_WIDTHS = ([1, 1, 1, 1] + [1, 1, 5, 5, 5] + [1, 5, 5] + [1, 1, 1, 1, 5, 5] +
+               [1, 5, 5] + [5, 3, 3] + [5, 3, 3])
+
+def board_state_widths(num_players):
+    """field widths of encode_board_state(), in order."""
+    return [2] + [1, 6] * num_players + [5] * NUM_TILES + [2, 5, 3, 3] * DBG_MAX_UNITS
+
+FIELD_LAYOUTS = {}   # widths => (field of each bit, shift of each bit)
+
+def field_layout(widths):
+    key = tuple(widths)
+    if key not in FIELD_LAYOUTS:
+        widths = numpy.array(key, numpy.int64)
+        ends = numpy.repeat(numpy.cumsum(widths), widths)
+        FIELD_LAYOUTS[key] = (numpy.repeat(numpy.arange(len(key)), widths),
+                              ends - 1 - numpy.arange(ends.size))
+    return FIELD_LAYOUTS[key]
+
+def field_bits(values, widths):
+    """values as big-endian bit fields of the given widths, like "{0:05b}".format().
+    values must fit their widths."""
+    field_idx, shifts = field_layout(widths)
+    return ((numpy.asarray(values, numpy.int64)[field_idx] >> shifts) & 1).astype(numpy.uint8)
+
+def bits_fields(bits, widths):
+    """inverse of field_bits: the values of consecutive fields from the start of bits."""
+    field_idx, shifts = field_layout(widths)
+    weighted = bits[:shifts.size].astype(numpy.int64) << shifts
+    return numpy.add.reduceat(weighted, numpy.searchsorted(field_idx, numpy.arange(len(widths))))
+
+def terrain_value(tile):
+    """the number emit_tile_terrain() writes."""
+    terrain_name = tile['terrain_name']
+    if terrain_name in bblib.CAPTURABLE_TERRAIN:
+        terrain_name += str(bblib.bldg_army_id(tile))
+    return TERRAIN_VALUES[terrain_name]
+
+def unit_info_values(tile, done):
+    """the numbers append_unit_info() writes -- and like it, gives units without
+    a health 100% health."""
+    unit_type = tile.get('unit_name')
+    if bblib.is_loaded_unicorn(tile) or  bblib.is_loaded_skateboard(tile):
+        unit_type += tile['slot1_deployed_unit_name']
+    if 'unit_name' in tile and 'health' not in tile: tile['health'] = "100"
+    if done:
+        return [0, 0, 0]
+    health = tile.get('health')
+    return [UNIT_VALUES[unit_type], int(tile.get('unit_army_id') or 4)+1,
+            int(int(health if health else -20)/20)+2]
+
+def encode_board_state_bits(army_id_turn, resigned, game_info, tiles_list):
+    """encode_board_state(), as a numpy array of bits."""
+    values = [army_id_turn]
+    for player_info in game_info['players'].values():
+        values += [int(resigned[player_info['army_id']]),
+                   min(int(int(player_info['funds']) / 1000), 63)]
+    tiles = tiles_list[:NUM_TILES]
+    values += [terrain_value(tile) for tile in tiles] + [0] * (NUM_TILES - len(tiles))
+    units = [tile for tile in tiles if bblib.has_unit(tile)]
+    if len(units) > DBG_MAX_UNITS:
+        return None
+    for tile in units:
+        values.append(MOVED_STATES[tile.get('moved')])
+        values += unit_info_values(tile, False)
+    values += [0] * (4 * (DBG_MAX_UNITS - len(units)))
+    return field_bits(values, board_state_widths(len(game_info['players'])))
+
+def encode_move_bits(move, tiles_by_idx):
+    """encode_move(), as a numpy array of bits."""
+    def tile_locs(boolval, idx):
+        xpos = tiles_by_idx.get(idx, NO_TILE)['x'] if boolval else 0
+        return [xpos, xpos]     # see emit_tile_loc
+    data = move['data']
+    done = move.get('stop_worker_num', '') != ''
+    has_data = bool(data)
+    skip = done or not has_data
+    has_purchase = bool(data.get('purchase', False)) and not skip
+    purchase = data['purchase'] if has_purchase else {}
+    values = [done, has_data, bool(data.get('end_turn', False)), skip, has_purchase, 0,
+              UNIT_VALUES[purchase['unit_name']] if has_purchase else 0]
+    values += tile_locs(has_purchase, bblib.movedict_xyidx(purchase))
+    movemove = data.get('move', False)
+    has_move = bool(movemove) and not skip
+    if not movemove: movemove = {'xCoordinate':-1,'yCoordinate':-1}
+    src_xyidx = bblib.movedict_xyidx(movemove)
+    unit_action = movemove.get('unit_action') if not skip else None
+    has_unload = unit_action == 'unloadSlot1'
+    action_xyidx = int(movemove.get('y_coord_action', -1))*1000 + \
+                   int(movemove.get('x_coord_action', -1))
+    attack_xyidx = int(movemove.get('y_coord_attack', -1))*1000 + \
+                   int(movemove.get('x_coord_attack', -1))
+    values += [has_move] + tile_locs(has_move, src_xyidx)
+    values += [unit_action == 'join', unit_action == 'load', unit_action == 'capture',
+               has_unload] + tile_locs(has_unload, action_xyidx)
+    values += [('x_coord_attack' in movemove) and not skip] + tile_locs(has_unload, attack_xyidx)
+    values += unit_info_values(tiles_by_idx.get(src_xyidx, {}), skip)
+    values += unit_info_values(tiles_by_idx.get(attack_xyidx, {}), skip)
+    return field_bits(values, MOVE_WIDTHS)
+
+def record_num_players(num_bits):
+    """the number of players in a board+move record of num_bits bits."""
+    return (num_bits - sum(board_state_widths(0)) - sum(MOVE_WIDTHS)) // 7
+
+def decode_board_move_state(bits, num_players=None):
+    """the fields of a board+move record's bits, e.g. from read_board_move_state_packed:
+    army_id_turn, resigned and funds per player, terrain per tile, units (moved, unit,
+    army, health per slot), and the move's fields in encode_move() order."""
+    if num_players is None:
+        num_players = record_num_players(len(bits))
+    widths = board_state_widths(num_players)
+    values = bits_fields(bits, widths + MOVE_WIDTHS)
+    pos = 1 + 2 * num_players
+    return { 'army_id_turn': int(values[0]),
+             'resigned': values[1:pos:2], 'funds': values[2:pos:2],
+             'terrain': values[pos:pos+NUM_TILES],
+             'units': values[pos+NUM_TILES:len(widths)].reshape(DBG_MAX_UNITS, 4),
+             'move': values[len(widths):] }
+
+def bits_str(bits):
+    """a record's bits in the text format, e.g. to convert packed files to it."""
+    return (numpy.asarray(bits, numpy.uint8) + ord('0')).tobytes().decode('ascii')
+
+def write_board_move_state_packed(winning_army_id_str, board_move_states):
+    """like write_board_move_state, for encode_board_state_bits + encode_move_bits
+    records: PACKED_HEADER, then per record a won/lost byte and the packed bits."""
+    winning_army_id = int(winning_army_id_str)
+    filename = 'board-{}.bits.bz2'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
+    records = (numpy.array(board_move_states, numpy.uint8).reshape(len(board_move_states), -1)
+               if board_move_states else numpy.zeros((0, 0), numpy.uint8))
+    if len(records) > 0:
+        print('writing board state to {}: {} moves, {} bits each'.format(
+            filename, len(records), records.shape[1]))
+    # same label as the text format: the army_id_turn bits vs the winner's army_id
+    labels = (records[:, 0] * 2 + records[:, 1] == winning_army_id).astype(numpy.uint8)
+    rows = numpy.concatenate([labels[:, None], numpy.packbits(records, axis=1)], axis=1)
+    pieces = [row.tobytes() for row in rows] or [b'']
+    pieces[0] = PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, records.shape[1],
+                                   len(records), bytes.fromhex(CODE_TABLES_DIGEST)) + pieces[0]
+    write_bz2_streams(filename, pieces)
+
+def read_board_move_state_packed(filename):
+    """(labels, bits) for a file from write_board_move_state_packed: a 0/1 won label
+    per record, and a (records, bits per record) array of 0/1 bits."""
+    with bz2.open(filename, 'rb') as fh:
+        data = fh.read()
+    try:
+        num_bits, num_records, header_size = parse_packed_header(data)
+    except ValueError as exc:
+        raise ValueError('{}: {}'.format(filename, exc))
+    row_bytes = 1 + (num_bits + 7) // 8
+    rows = numpy.frombuffer(data, numpy.uint8, num_records * row_bytes,
+                            header_size).reshape(num_records, row_bytes)
+    return rows[:, 0].copy(), numpy.unpackbits(rows[:, 1:], axis=1)[:, :num_bits]
 
 def is_move_attack(move):
     movemove = move.get('data', {}).get('move')
     return ('x_coord_attack' in movemove) if movemove else False
 
+MOVE_FLAGS = ['end_turn', 'purchase', 'move', 'attack', 'capture', 'load', 'join', 'unload']
+UNIT_ACTION_FLAGS = {'capture': 'capture', 'load': 'load', 'join': 'join',
+                     'unloadSlot1': 'unload'}
+# MOVE_FLAGS => encode_move() field number
+MOVE_FLAG_FIELDS = {'end_turn': 2, 'purchase': 4, 'move': 9, 'attack': 18, 'capture': 14,
+                    'load': 13, 'join': 12, 'unload': 15}
+
+def move_flags(move):
+    """a move's MOVE_FLAGS, as a bitmask (bit i = MOVE_FLAGS[i])."""
+    data = move.get('data') or {}
+    movemove = data.get('move') or {}
+    names = set()
+    if data.get('end_turn', False): names.add('end_turn')
+    if data.get('purchase', False): names.add('purchase')
+    if movemove: names.add('move')
+    if is_move_attack(move): names.add('attack')
+    if movemove.get('unit_action') in UNIT_ACTION_FLAGS:
+        names.add(UNIT_ACTION_FLAGS[movemove['unit_action']])
+    return flag_mask(*names)
+
+def move_bits_flags(move_values):
+    """move_flags(), from the encode_move() fields of decode_board_move_state."""
+    return flag_mask(*[name for name, field in MOVE_FLAG_FIELDS.items() if move_values[field]])
+
+def flag_mask(*names):
+    """the flags bits for names, e.g. flags & flag_mask('attack') != 0"""
+    return sum([1 << MOVE_FLAGS.index(name) for name in names])
+
 def encode_attack(move, tiles_by_idx, dbgloc=None):
     def dbgbitmap(bitmap, msg, dbgloc=dbgloc):
         if dbgloc is not None:
@@ -227,11 +475,10 @@ def encode_attack(move, tiles_by_idx, dbgloc=None):
 
 def extract_attack_state_json(board_move_state, tiles_by_idx):
     movemove = board_move_state['move']['data']['move']
-    print('movemove: {}'.format(movemove))
-    print('board_move_state: {}'.format(board_move_state['board']))
     res = {'attacker_neighbors': [], 'defender_neighbors': [], 'move': movemove}
     attacker = defender = None
-    attacker_x, attacker_y = int(movemove['x_coordinate']), int(movemove['y_coordinate'])
+    attacker_xyidx = bblib.movedict_xyidx(movemove)
+    attacker_x, attacker_y = attacker_xyidx % 1000, attacker_xyidx // 1000
     print('attacker: {},{}'.format(attacker_x, attacker_y))
     for dx in range(-2,3):
         for dy in range(-2,3):
@@ -252,36 +499,290 @@ def extract_attack_state_json(board_move_state, tiles_by_idx):
     print(attacker)
     print(defender)
     res['dmg20'] = 20 * int(bblib.compute_damage(attacker, defender) / 20)
-    sys.exit(0)
     return res
 
-if __name__ == '__main__':
-    movetype = sys.argv[1]
-    if sys.argv[2] == '-':
-        fh = sys.stdin
-    elif 'bz2' in sys.argv[2]:
-        fh = bz2.open(sys.argv[2], 'r')
+#---------------------------------------------------------------------------
+# reading recorded games: the board-*.txt.bz2, .json.bz2 and .bits.bz2 files above.
+# iter_records() streams a file's records, decoding only the fields asked for, and
+# can filter them (RECORD_FILTERS).  index_game_file() writes a sidecar <file>.idx
+# with each record's offset, label and MOVE_FLAGS, so read_records() and
+# sample_records() decompress only the bz2 streams their records are in: files
+# written above are split into STREAM_BYTES streams, and rewrite_streams() converts
+# older, single-stream files the same way.
+#
+
+INDEX_VERSION = 1
+READ_CHUNK_BYTES = 1 << 16
+
+# record fields: 'label' (1 if the move's army won) and 'flags' (MOVE_FLAGS bits)
+# for every format; 'line' (the text format line), 'bits' (numpy 0/1 array) and
+# 'fields' (decode_board_move_state) for .txt/.bits; 'json' and 'tiles' (the board,
+# parsed) for .json.  every record also has 'num', its record number in the file.
+DEFAULT_FIELDS = ('label', 'flags')
+
+RECORD_FILTERS = {
+    'attack': lambda rec: rec['flags'] & flag_mask('attack') != 0,
+    'capture': lambda rec: rec['flags'] & flag_mask('capture') != 0,
+    'purchase': lambda rec: rec['flags'] & flag_mask('purchase') != 0,
+    'winner': lambda rec: rec['label'] == 1,
+}
+
+def game_file_format(path):
+    """'txt', 'json' or 'bits'.  '-' is text format lines on stdin."""
+    if path == '-':
+        return 'txt'
+    for fmt in ('txt', 'json', 'bits'):
+        if path.endswith('.{}.bz2'.format(fmt)):
+            return fmt
+    raise ValueError('{}: not a board-*.txt.bz2, .json.bz2 or .bits.bz2 file'.format(path))
+
+def bz2_chunks(fh, streams=None):
+    """the uncompressed bytes of a bz2 file, one or many streams, in chunks, from
+    fh's position.  appends [compressed offset, uncompressed offset] per stream to
+    streams."""
+    comp_pos, uncomp_pos = fh.tell(), 0
+    decompressor, pending = None, b''
+    while True:
+        if not pending:
+            pending = fh.read(READ_CHUNK_BYTES)
+            if not pending:
+                break
+        if decompressor is None:
+            decompressor = bz2.BZ2Decompressor()
+            if streams is not None: streams.append([comp_pos, uncomp_pos])
+        data = decompressor.decompress(pending)
+        if decompressor.eof:
+            comp_pos += len(pending) - len(decompressor.unused_data)
+            pending, decompressor = decompressor.unused_data, None
+        else:
+            comp_pos, pending = comp_pos + len(pending), b''
+        uncomp_pos += len(data)
+        if data:
+            yield data
+    if decompressor is not None:
+        raise EOFError('truncated bz2 stream at offset {}'.format(comp_pos))
+
+def record_spans(fmt, chunks, info):
+    """(uncompressed offset, raw record) per record in the uncompressed bytes from
+    chunks: a line for txt, a row for bits (whose header goes into info), and the
+    parsed record for json, whose separators ('[', ', ', ']') are skipped."""
+    buf, base, pos = b'', 0, 0
+    chunks = iter(chunks)
+    if fmt == 'bits':
+        for chunk in chunks:
+            buf += chunk
+            if len(buf) >= PACKED_HEADER.size: break
+        info['num_bits'], _, pos = parse_packed_header(buf)
+        chunks = itertools.chain([b''], chunks)   # the rows already in buf
+    decoder = json.JSONDecoder()
+    for chunk in chunks:
+        buf += chunk
+        if fmt == 'txt':
+            while True:
+                end = buf.find(b'\n', pos)
+                if end < 0: break
+                yield base + pos, buf[pos:end]
+                pos = end + 1
+        elif fmt == 'bits':
+            row_bytes = 1 + (info['num_bits'] + 7) // 8
+            while pos + row_bytes <= len(buf):
+                yield base + pos, buf[pos:pos+row_bytes]
+                pos += row_bytes
+        else:
+            # records are ASCII (json.dumps), so character and byte offsets agree
+            text = buf.decode('ascii')
+            while True:
+                while pos < len(text) and text[pos] in ' \t\r\n[,]':
+                    pos += 1
+                try:
+                    record, end = decoder.raw_decode(text, pos)
+                except ValueError:
+                    break     # incomplete: wait for the next chunk
+                yield base + pos, record
+                pos = end
+        buf, base, pos = buf[pos:], base + pos, 0
+    if fmt == 'txt' and buf:
+        yield base, buf
+    elif fmt == 'json' and buf.strip(b' \t\r\n[,]'):
+        raise ValueError('truncated JSON record at offset {}'.format(base))
+
+def decode_record(fmt, num, raw, fields, info):
+    """a record's fields, from its raw record_spans() value or bytes."""
+    rec = { 'num': num }
+    if fmt == 'json':
+        jsondata = raw if isinstance(raw, dict) else json.JSONDecoder().raw_decode(
+            raw.decode('ascii').lstrip(' \t\r\n[,'))[0]
+        if 'label' in fields: rec['label'] = int(jsondata.get('move_led_to_win', 0))
+        if 'flags' in fields: rec['flags'] = move_flags(jsondata['move'])
+        if 'json' in fields: rec['json'] = jsondata
+        if 'tiles' in fields:
+            rec['tiles'] = bblib.parse_map(jsondata['army_id'], jsondata['board']['tiles'],
+                                           jsondata['board']).tiles_by_idx
+        return rec
+    if fmt == 'txt':
+        label, bitstr = raw.rstrip(b'\r\n').split(b'\t')
+        if 'label' in fields: rec['label'] = int(label)
+        if 'line' in fields: rec['line'] = (label + b'\t' + bitstr).decode('ascii')
+        if 'flags' in fields:
+            rec['flags'] = move_bits_flags(bits_fields(numpy.frombuffer(
+                bitstr[-sum(MOVE_WIDTHS):], numpy.uint8) - ord('0'), MOVE_WIDTHS))
+        if 'bits' in fields or 'fields' in fields:
+            bits = numpy.frombuffer(bitstr, numpy.uint8) - ord('0')
     else:
-        fh = open(sys.argv[2])
-    if re.search(r'json', movetype):
-        board_game_states = json.loads(fh.read().decode())
-        # legacy
-        if len(board_game_states) == 1: board_game_states = board_game_states[0] 
-        for state in board_game_states:
-            tiles_by_idx = bblib.parse_map(state['army_id'], state['board']['tiles'],
-                                           state['board'])
-            if movetype == 'attack_state_json' and is_move_attack_json(state):
-                print(extract_attack_state_json(state, tiles_by_idx))
-            print(bblib.combined_map(list(tiles_by_idx.values()), state['army_id']))
-        sys.exit(0)
-            
-    for line in fh:
-        state = line[2:-1]  # trim newline
-        print(restore_tile(state, 0,0))
-        if movetype == 'attack_state' and is_move_attack(state):
-            print(extract_attack_state(state))
+        if 'label' in fields: rec['label'] = raw[0]
+        bits = numpy.unpackbits(numpy.frombuffer(raw, numpy.uint8, offset=1))[:info['num_bits']]
+        if 'line' in fields: rec['line'] = '{}\t{}'.format(raw[0], bits_str(bits))
+        if 'flags' in fields:
+            rec['flags'] = move_bits_flags(bits_fields(bits[-sum(MOVE_WIDTHS):], MOVE_WIDTHS))
+    if 'bits' in fields: rec['bits'] = bits
+    if 'fields' in fields: rec['fields'] = decode_board_move_state(bits)
+    return rec
+
+def record_filter(filters):
+    """a predicate for records matching all the RECORD_FILTERS names in filters."""
+    for name in filters:
+        if name not in RECORD_FILTERS:
+            raise ValueError('unknown filter {}: use {}'.format(
+                name, ', '.join(sorted(RECORD_FILTERS))))
+    predicates = [RECORD_FILTERS[name] for name in filters]
+    return lambda rec: all([predicate(rec) for predicate in predicates])
+
+def iter_records(path, fields=DEFAULT_FIELDS, filters=()):
+    """streams path's records (see DEFAULT_FIELDS) matching filters, decompressing
+    a chunk at a time."""
+    fmt, info, matches = game_file_format(path), {}, record_filter(filters)
+    fields = set(fields) | (set(['label', 'flags']) if filters else set())
+    if path == '-':
+        chunks = iter(lambda: sys.stdin.buffer.read(READ_CHUNK_BYTES), b'')
+        fh = None
+    else:
+        fh = open(path, 'rb')
+        chunks = bz2_chunks(fh)
+    try:
+        for num, (_, raw) in enumerate(record_spans(fmt, chunks, info)):
+            rec = decode_record(fmt, num, raw, fields, info)
+            if matches(rec):
+                yield rec
+    finally:
+        if fh is not None: fh.close()
+
+def index_path(path):
+    return path + '.idx'
+
+def index_game_file(path):
+    """reads path once, writes its sidecar index (JSON) and returns it: the stream
+    and record offsets, and each record's label and flags."""
+    fmt, streams, info = game_file_format(path), [], {}
+    offsets, labels, flags = [], [], []
+    with open(path, 'rb') as fh:
+        for num, (offset, raw) in enumerate(record_spans(fmt, bz2_chunks(fh, streams), info)):
+            rec = decode_record(fmt, num, raw, DEFAULT_FIELDS, info)
+            offsets.append(offset)
+            labels.append(int(rec['label']))
+            flags.append(rec['flags'])
+        size = fh.tell()
+    index = { 'version': INDEX_VERSION, 'format': fmt, 'info': info,
+              'size': size, 'mtime': os.stat(path).st_mtime, 'streams': streams,
+              'offsets': offsets, 'labels': labels, 'flags': flags }
+    tmp_path = '{}.tmp-{}'.format(index_path(path), os.getpid())
+    with open(tmp_path, 'w') as index_fh:
+        json.dump(index, index_fh, separators=(',', ':'))
+    os.replace(tmp_path, index_path(path))
+    return index
+
+def load_index(path):
+    """path's sidecar index, (re)built if it's missing or older than path."""
+    try:
+        with open(index_path(path)) as index_fh:
+            index = json.load(index_fh)
+        stat = os.stat(path)
+        if (index['version'] == INDEX_VERSION and index['size'] == stat.st_size and
+                index['mtime'] == stat.st_mtime):
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    return index_game_file(path)
+
+def read_records(path, nums, fields=DEFAULT_FIELDS, index=None):
+    """the records numbered nums, in order, decompressing only from the bz2 stream
+    each one starts in (and only as far as it ends)."""
+    index = index or load_index(path)
+    fmt, offsets, streams = index['format'], index['offsets'], index['streams']
+    stream_starts = [uncomp_offset for _, uncomp_offset in streams]
+    window_start, window, chunks = None, b'', None
+    with open(path, 'rb') as fh:
+        for num in sorted(nums):
+            start = offsets[num]
+            end = offsets[num+1] if num+1 < len(offsets) else None
+            stream = bisect.bisect_right(stream_starts, start) - 1
+            # keep decompressing from where we are, unless the record's stream is ahead
+            if window_start is None or stream_starts[stream] > window_start + len(window):
+                fh.seek(streams[stream][0])
+                chunks = bz2_chunks(fh)
+                window_start, window = stream_starts[stream], b''
+            while end is None or window_start + len(window) < end:
+                chunk = next(chunks, None)
+                if chunk is None: break
+                window += chunk
+            window, window_start = window[start - window_start:], start
+            yield decode_record(fmt, num, window[:None if end is None else end - start],
+                                fields, index['info'])
+
+def sample_records(paths, num_samples, fields=DEFAULT_FIELDS, filters=(), rng=None):
+    """num_samples records (or all, if fewer) matching filters, picked at random from
+    paths using their indexes, and read with read_records.  records get a 'file'."""
+    rng, matches = rng or random.Random(), record_filter(filters)
+    indexes = dict([(path, load_index(path)) for path in paths])
+    candidates = [(path, num) for path, index in indexes.items()
+                  for num in range(len(index['offsets']))
+                  if matches({ 'label': index['labels'][num], 'flags': index['flags'][num] })]
+    picks = rng.sample(candidates, min(num_samples, len(candidates)))
+    for path in sorted(set([path for path, _ in picks])):
+        for rec in read_records(path, [num for pick_path, num in picks if pick_path == path],
+                                fields, indexes[path]):
+            rec['file'] = path
+            yield rec
+
+def rewrite_streams(path):
+    """rewrites a game file in STREAM_BYTES bz2 streams, the way it's written now
+    (the same uncompressed bytes), and reindexes it."""
+    fmt, info = game_file_format(path), {}
+    with bz2.open(path, 'rb') as fh:
+        data = fh.read()
+    cuts = [offset for offset, _ in record_spans(fmt, [data], info)][1:]
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    write_bz2_streams(tmp_path, [data[start:end] for start, end in
+                                 zip([0] + cuts, cuts + [len(data)])])
+    os.replace(tmp_path, path)
+    return index_game_file(path)
+
+def main():
+    """filter: prints the records of files (or '-', text lines on stdin) matching
+    comma-separated RECORD_FILTERS names ('all' for every record): the text format
+    line, or for .json records their board.  attack_state_json prints attacks'
+    neighborhoods.  index builds the .idx sidecars, rewrite converts files to
+    multi-stream."""
+    if len(sys.argv) < 3:
+        print('usage: {} <{}|all|attack_state_json|index|rewrite>[,...] <file>|- ...'.format(
+            sys.argv[0], '|'.join(sorted(RECORD_FILTERS))))
+        sys.exit(1)
+    command, paths = sys.argv[1], sys.argv[2:]
+    for path in paths:
+        if command in ('index', 'rewrite'):
+            index = (index_game_file if command == 'index' else rewrite_streams)(path)
+            print('{}: {} records in {} bz2 streams'.format(
+                path, len(index['offsets']), len(index['streams'])))
             continue
-        if (movetype == 'capture' and is_move_capture(state)) or \
-           (movetype == 'attack' and is_move_attack(state)) or \
-           False:
-            print(state)
+        filters = ['attack'] if command == 'attack_state_json' else \
+                  [name for name in command.split(',') if name != 'all']
+        fields = ('line',) if game_file_format(path) != 'json' else ('json', 'tiles')
+        for rec in iter_records(path, fields, filters):
+            if 'line' in rec:
+                print(rec['line'])
+            elif command == 'attack_state_json':
+                print(extract_attack_state_json(rec['json'], rec['tiles']))
+            else:
+                print(bblib.combined_map(list(rec['tiles'].values()), rec['json']['army_id']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+#
+# dataset.py - sharded, append-only store for self-play board+move states
+#
+# with DATASET_DIR set, sim.py (and so selfplay.py) appends each game's moves here,
+# instead of writing two board-<timestamp> files per game.  a shard is a directory of
+# column files, one fixed-width numpy value per move:
+#
+#   state.bin     uint8[bytes]  the board+move bits, numpy.packbits'd (board_move_state)
+#   label.bin     uint8         1 if the move's army won the game (move_led_to_win)
+#   game_id.bin   uint64        random per game, see games.jsonl
+#   move_idx.bin  uint32        the move's number within its game
+#   turn.bin      uint16        player turn index, as in the state's army_id_turn bits
+#   army_id.bin   uint8
+#   flags.bin     uint8         board_move_state.MOVE_FLAGS bits, see flag_mask()
+#
+# plus games.jsonl (a line per game: result, seed, first row) and, if DATASET_JSON,
+# moves.json.bz2: each game's per-move JSON as its own bz2 stream, at the offset in
+# games.jsonl.  manifest.json holds the column layout, the digest of the terrain/unit
+# codes the states were encoded with (shards with other codes are refused), and the
+# committed row count and file sizes.
+#
+# every process writes shards of its own (named for host, pid and start time), so
+# concurrent sims need no locking.  a game's rows are appended first and the manifest
+# is replaced atomically after, so readers only see whole games; a failed append
+# leaves a tail that readers ignore and the next append overwrites.  shards roll over
+# at DATASET_SHARD_MB of states, and hold one state width only (the bits per move
+# depend on the number of players).
+#
+# training memory-maps the columns:
+#   for shard in dataset.load_shards('selfplay-data'):
+#       states, labels = shard['state'], shard['label']   # numpy.memmap's
+#
+#   ./dataset.py selfplay-data    # prints shard, game and move counts
+#
+import sys, os, json, bz2, glob, time, random, socket
+import numpy
+import board_move_state as bms
+
+DATASET_DIR = os.environ.get('DATASET_DIR', '')   # '' = per-game board-* files
+DATASET_SHARD_MB = float(os.environ.get('DATASET_SHARD_MB', '256'))
+DATASET_JSON = (os.environ.get('DATASET_JSON', '1') == '1')   # keep per-move JSON
+
+DATASET_VERSION = 1
+
+# name => (dtype, shape per row); 'state' is (bytes per row,) -- see shard_columns
+META_COLUMNS = [('label', 'uint8'), ('game_id', 'uint64'), ('move_idx', 'uint32'),
+                ('turn', 'uint16'), ('army_id', 'uint8'), ('flags', 'uint8')]
+
+def shard_columns(state_bits):
+    """name => (dtype, shape per row), for shards of state_bits bits per move."""
+    columns = dict([(name, (dtype, ())) for name, dtype in META_COLUMNS])
+    columns['state'] = ('uint8', ((state_bits + 7) // 8,))
+    return columns
+
+def write_json_atomic(path, jsondata):
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as tmp_fh:
+        json.dump(jsondata, tmp_fh, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+class DatasetWriter(object):
+    """appends games to this process's shards in dataset_dir."""
+    def __init__(self, dataset_dir, shard_mb=None, keep_json=None):
+        self.dataset_dir = dataset_dir
+        self.shard_bytes = int((DATASET_SHARD_MB if shard_mb is None else shard_mb) * (1 << 20))
+        self.keep_json = DATASET_JSON if keep_json is None else keep_json
+        self.pid = os.getpid()
+        self.writer_id = '{}-{}-{}'.format(socket.gethostname(), self.pid,
+                                           time.strftime('%Y%m%d%H%M%S'))
+        self.rng = random.SystemRandom()
+        self.shards = {}      # state bits => manifest of the shard being filled
+        self.num_shards = 0
+        os.makedirs(dataset_dir, exist_ok=True)
+
+    def new_shard(self, state_bits):
+        self.num_shards += 1
+        name = 'shard-{}-{:04d}-{}b'.format(self.writer_id, self.num_shards, state_bits)
+        os.makedirs(os.path.join(self.dataset_dir, name))
+        manifest = { 'version': DATASET_VERSION, 'layout_version': bms.PACKED_VERSION,
+                     'code_tables': bms.CODE_TABLES_DIGEST, 'name': name, 'state_bits': state_bits,
+                     'rows': 0, 'games': 0, 'bytes': {},
+                     'columns': dict([(col, [dtype, list(shape)]) for col, (dtype, shape)
+                                      in shard_columns(state_bits).items()]) }
+        write_json_atomic(os.path.join(self.dataset_dir, name, 'manifest.json'), manifest)
+        return manifest
+
+    def shard_for(self, state_bits):
+        manifest = self.shards.get(state_bits)
+        if manifest is None or manifest['rows'] * ((state_bits + 7) // 8) >= self.shard_bytes:
+            manifest = self.shards[state_bits] = self.new_shard(state_bits)
+        return manifest
+
+    def append_game(self, game_result, states, moves_json):
+        """appends one game: its sim.GameResult, the encode_board_state_bits +
+        encode_move_bits array per move, and the write_board_move_state_json record
+        per move.  returns the game's games.jsonl entry."""
+        if len(states) == 0:
+            return None
+        winner = game_result.winner
+        states = numpy.array(states, numpy.uint8).reshape(len(states), -1)
+        manifest = self.shard_for(states.shape[1])
+        shard_dir = os.path.join(self.dataset_dir, manifest['name'])
+        game_id = self.rng.getrandbits(63)
+        army_ids = numpy.array([int(jsondata['army_id']) for jsondata in moves_json])
+        labels = (army_ids == (-1 if winner is None else int(winner)))
+        values = { 'state': numpy.packbits(states, axis=1), 'label': labels,
+                   'game_id': numpy.full(len(states), game_id),
+                   'move_idx': numpy.arange(len(states)),
+                   'turn': numpy.array([jsondata['turn'] for jsondata in moves_json]),
+                   'army_id': army_ids,
+                   'flags': numpy.array([bms.move_flags(jsondata['move'])
+                                         for jsondata in moves_json]) }
+        sizes = dict(manifest['bytes'])
+        for col, (dtype, _) in shard_columns(manifest['state_bits']).items():
+            append_bytes(shard_dir, col + '.bin', sizes,
+                         numpy.ascontiguousarray(values[col], dtype).tobytes())
+        game = game_result.as_dict()
+        game.update({ 'game_id': game_id, 'first_row': manifest['rows'],
+                      'rows': len(states) })
+        if self.keep_json:
+            for jsondata in moves_json:
+                jsondata['move_led_to_win'] = int(jsondata['army_id'] == winner)
+            game['json_offset'] = append_bytes(
+                shard_dir, 'moves.json.bz2', sizes,
+                bz2.compress(json.dumps(moves_json).encode('utf-8')))
+        append_bytes(shard_dir, 'games.jsonl', sizes,
+                     (json.dumps(game, sort_keys=True) + '\n').encode('utf-8'))
+        # commit: readers only trust the manifest's rows and sizes
+        manifest.update({ 'rows': manifest['rows'] + len(states),
+                          'games': manifest['games'] + 1, 'bytes': sizes })
+        write_json_atomic(os.path.join(shard_dir, 'manifest.json'), manifest)
+        return game
+
+def append_bytes(shard_dir, filename, sizes, data):
+    """appends data at the file's committed size in sizes, dropping whatever a
+    failed append left past it, and updates sizes.  returns the offset written at."""
+    offset = sizes.get(filename, 0)
+    with open(os.path.join(shard_dir, filename), 'ab') as out_fh:
+        out_fh.truncate(offset)
+        out_fh.write(data)
+    sizes[filename] = offset + len(data)
+    return offset
+
+WRITERS = {}   # dataset dir => this process's DatasetWriter
+
+def dataset_writer(dataset_dir=None):
+    """this process's writer for dataset_dir (default DATASET_DIR).  forked children,
+    e.g. selfplay.py's workers, get writers of their own."""
+    dataset_dir = dataset_dir or DATASET_DIR
+    writer = WRITERS.get(dataset_dir)
+    if writer is None or writer.pid != os.getpid():
+        writer = WRITERS[dataset_dir] = DatasetWriter(dataset_dir)
+    return writer
+
+#---------------------------------------------------------------------------
+# reading: the columns of a shard's committed rows, memory-mapped
+#
+
+def shard_dirs(dataset_dir):
+    return sorted(glob.glob(os.path.join(dataset_dir, 'shard-*')))
+
+def read_manifest(shard_dir):
+    with open(os.path.join(shard_dir, 'manifest.json')) as manifest_fh:
+        manifest = json.load(manifest_fh)
+    if manifest['version'] != DATASET_VERSION:
+        raise ValueError('{}: dataset version {}, expected {}'.format(
+            shard_dir, manifest['version'], DATASET_VERSION))
+    if (manifest['layout_version'] != bms.PACKED_VERSION or
+            manifest.get('code_tables') != bms.CODE_TABLES_DIGEST):
+        raise ValueError('{}: states encoded with layout version {} and codes {}, '
+                         'expected {} and {}'.format(
+                             shard_dir, manifest['layout_version'], manifest.get('code_tables'),
+                             bms.PACKED_VERSION, bms.CODE_TABLES_DIGEST))
+    return manifest
+
+def load_shard(shard_dir, columns=None):
+    """column name => numpy.memmap of its committed rows (all columns by default),
+    plus 'manifest'.  an empty shard has empty arrays."""
+    manifest = read_manifest(shard_dir)
+    res = { 'manifest': manifest }
+    for col, (dtype, shape) in manifest['columns'].items():
+        if columns is not None and col not in columns:
+            continue
+        shape = (manifest['rows'],) + tuple(shape)
+        if manifest['rows'] == 0:
+            res[col] = numpy.zeros(shape, dtype)
+        else:
+            res[col] = numpy.memmap(os.path.join(shard_dir, col + '.bin'), dtype, 'r',
+                                    shape=shape)
+    return res
+
+def load_shards(dataset_dir, columns=None):
+    """load_shard() for every non-empty shard."""
+    shards = [load_shard(shard_dir, columns) for shard_dir in shard_dirs(dataset_dir)]
+    return [shard for shard in shards if shard['manifest']['rows'] > 0]
+
+def read_games(shard_dir):
+    """the games.jsonl entries of a shard's committed games."""
+    size = read_manifest(shard_dir)['bytes'].get('games.jsonl', 0)
+    if size == 0:
+        return []
+    with open(os.path.join(shard_dir, 'games.jsonl'), 'rb') as games_fh:
+        return [json.loads(line) for line in games_fh.read(size).decode('utf-8').splitlines()]
+
+def read_game_json(shard_dir, game):
+    """a game's per-move JSON records, decompressing only its own bz2 stream."""
+    decompressor = bz2.BZ2Decompressor()
+    chunks = []
+    with open(os.path.join(shard_dir, 'moves.json.bz2'), 'rb') as moves_fh:
+        moves_fh.seek(game['json_offset'])
+        while not decompressor.eof:
+            data = moves_fh.read(1 << 16)
+            if not data:
+                raise ValueError('{}: truncated JSON for game {}'.format(
+                    shard_dir, game['game_id']))
+            chunks.append(decompressor.decompress(data))
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+def main():
+    for dataset_dir in sys.argv[1:] or [DATASET_DIR]:
+        shards = load_shards(dataset_dir, ['label'])
+        print("{}: {} shards, {} games, {} moves ({} from winners)".format(
+            dataset_dir, len(shards), sum([shard['manifest']['games'] for shard in shards]),
+            sum([shard['manifest']['rows'] for shard in shards]),
+            sum([int(shard['label'].sum()) for shard in shards])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#
+# selfplay.py - plays many sim.py games across a process pool, e.g. for training data
+#
+#   ./selfplay.py
+#   SELFPLAY_GAMES=200 SELFPLAY_SEED=42 BOARD_FILENAME=test_blank_board.json,example_2p_Divide.json ./selfplay.py
+#
+# workers are reused from game to game, so interpreter startup, imports and board
+# parsing are paid once per worker, not per game.  each game's seed is derived from
+# SELFPLAY_SEED, so a run can be replayed, and any one game with sim.py:
+#   DBG_RAND_SEED=<seed> BOARD_FILENAME=<board> ./sim.py
+#
+import sys, os, time, json, random, contextlib, multiprocessing
+import basicbot_lib as bblib
+import sim
+
+SELFPLAY_GAMES = int(os.environ.get('SELFPLAY_GAMES', '100'))
+SELFPLAY_WORKERS = int(os.environ.get('SELFPLAY_WORKERS', '0'))   # 0 = one per cpu
+SELFPLAY_SEED = int(os.environ.get('SELFPLAY_SEED', '1337'))      # the master seed
+# each game's printout goes to <dir>/game-<number>.txt; '' discards it
+SELFPLAY_LOG_DIR = os.environ.get('SELFPLAY_LOG_DIR', '')
+SELFPLAY_OUTPUT = os.environ.get('SELFPLAY_OUTPUT', '')           # results as JSON
+# comma separated: games are spread evenly across the boards
+BOARD_FILENAMES = os.environ.get('BOARD_FILENAME', sim.BOARD_FILENAME).split(',')
+
+def game_tasks(num_games, master_seed, board_filenames):
+    """(game number, board, seed) per game: the same for the same arguments."""
+    seed_rng = random.Random(master_seed)
+    return [(gamenum, board_filenames[gamenum % len(board_filenames)],
+             seed_rng.randrange(1 << 31)) for gamenum in range(num_games)]
+
+def init_worker():
+    bblib.ignore_sigint()
+    # the games are the parallelism: workers can't start pools of their own
+    bblib.PARALLEL_MOVE_DISCOVERY = False
+
+def play_game(task):
+    gamenum, board_filename, seed = task
+    if SELFPLAY_LOG_DIR:
+        log_fh = open(os.path.join(SELFPLAY_LOG_DIR, 'game-{}.txt'.format(gamenum)), 'w')
+    else:
+        log_fh = open(os.devnull, 'w')
+    with log_fh, contextlib.redirect_stdout(log_fh):
+        try:
+            result = sim.run_game(board_filename, seed, verbose=bool(SELFPLAY_LOG_DIR))
+        except Exception as exc:    # pylint:disable=broad-except
+            print("game #{} failed: {!r}".format(gamenum, exc))
+            result = sim.GameResult(board_filename, seed, None, 'error', 0, 0, 0.0)
+    return gamenum, result.as_dict()
+
+def summarize(results, board_filenames):
+    """win/draw/error counts overall and per board.  a draw is a game that hit
+    MAX_TURNS; other games without a winner (errors, max_units, state_bits) aren't
+    draws, and crashed games are counted as errors."""
+    def stats(games):
+        wins = {}
+        for game in games:
+            if game['winner'] is not None:
+                wins[game['winner']] = wins.get(game['winner'], 0) + 1
+        return { 'games': len(games), 'wins': wins,
+                 'draws': sum([game['reason'] == 'max_turns' for game in games]),
+                 'errors': sum([game['reason'] == 'error' for game in games]),
+                 'reasons': dict([(reason, sum([game['reason'] == reason for game in games]))
+                                  for reason in sorted(set(game['reason'] for game in games))]),
+                 'avg_turns': round(sum([game['turns'] for game in games]) /
+                                    max(1, len(games)), 1) }
+    res = stats(results)
+    res['boards'] = dict([(board_filename, stats([game for game in results if
+                                                  game['board_filename'] == board_filename]))
+                          for board_filename in board_filenames])
+    return res
+
+def main():
+    if SELFPLAY_LOG_DIR:
+        os.makedirs(SELFPLAY_LOG_DIR, exist_ok=True)
+    tasks = game_tasks(SELFPLAY_GAMES, SELFPLAY_SEED, BOARD_FILENAMES)
+    workers = SELFPLAY_WORKERS or multiprocessing.cpu_count()
+    print("playing {} games on {} with {} workers, master seed {}".format(
+        len(tasks), ",".join(BOARD_FILENAMES), workers, SELFPLAY_SEED))
+    start = time.time()
+    results = [None] * len(tasks)
+    pool = multiprocessing.Pool(workers, init_worker)
+    try:
+        for gamenum, result in pool.imap_unordered(play_game, tasks):
+            results[gamenum] = result
+            print("game #{} ({}, seed {}): {} after {} turns, {:.1f}s".format(
+                gamenum, result['board_filename'], result['seed'],
+                "army #{} won".format(result['winner']) if result['winner'] is not None
+                else "no winner", result['turns'], result['elapsed_sec']))
+            sys.stdout.flush()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    elapsed = time.time() - start
+    summary = summarize(results, BOARD_FILENAMES)
+    summary.update({ 'master_seed': SELFPLAY_SEED, 'workers': workers,
+                     'elapsed_sec': round(elapsed, 1),
+                     'games_per_min': round(60.0 * len(tasks) / elapsed, 2) })
+    print(json.dumps(summary, indent=2, sort_keys=True))
+    if SELFPLAY_OUTPUT:
+        with open(SELFPLAY_OUTPUT, 'w') as output_fh:
+            json.dump({ 'summary': summary, 'games': results }, output_fh,
+                      indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 # -*- compile-command: "/usr/local/bin/python3 sim.py" -*-
+#
+# sim.py - basicbot plays one game against itself.  run_game() is the library
+# entry point, e.g. for selfplay.py, which plays many games in a process pool.
+#
 
-import json, copy, sys, os, time
-import basicbot_lib as bblib, board_move_state as bms
+import json, copy, os, time
+import numpy
+import basicbot_lib as bblib, board_move_state as bms, dataset
 
 DBG_GAME_STATE = (os.environ.get('DBG_GAME_STATE', '0') == '1')
 DBG_BITMAP = (os.environ.get('DBG_BITMAP', '0') == '1')
@@ -11,39 +16,65 @@ RESIGN_THRES = float(os.environ.get('RESIGN_THRES', '0.66'))
 
 BOARD_FILENAME = os.environ.get('BOARD_FILENAME', 'test_blank_board.json')
 
-MASTER_TILES_BY_IDX = None
+BOARDS = {}   # board filename => its JSON, so a process reads each board once
 
-BOARD_MOVE_STATES = []
-BOARD_MOVE_STATES_JSON = []
+class GameResult(object):
+    """how one game ended.  winner is the winning army_id, or None if nobody won;
+    reason is 'resigned', 'captured', 'max_turns', 'max_units' or 'state_bits'
+    (the only ending whose moves aren't saved)."""
+    def __init__(self, board_filename, seed, winner, reason, turns, moves, elapsed_sec):
+        self.board_filename, self.seed = board_filename, seed
+        self.winner, self.reason = winner, reason
+        self.turns, self.moves, self.elapsed_sec = turns, moves, elapsed_sec
 
-def make_move(movenum, jsondata):
-    """returns move"""
+    def as_dict(self):
+        return dict(self.__dict__)
+
+def load_board(board_filename):
+    """a fresh copy of the board's JSON."""
+    if board_filename not in BOARDS:
+        with open(board_filename) as board_fh:
+            BOARDS[board_filename] = json.loads(board_fh.read())
+    return copy.deepcopy(BOARDS[board_filename])
+
+def make_move(master_state, master_tiles_by_idx, jsondata):
+    """returns move, and the (fogged) GameState it was chosen from"""
     player_id = str(jsondata['botPlayerId'])
     player_info = jsondata['gameInfo']['players'][player_id]
     army_id = player_info['army_id']
     if DBG_GAME_STATE:
         print("taking turn for player_id={}: funds={}".format(player_id, player_info['funds']))
-    bblib.TILES_BY_IDX = copy.deepcopy(MASTER_TILES_BY_IDX)
-    bblib.parse_tiles_by_idx(army_id, bblib.TILES_BY_IDX)
-    bblib.set_fog_values(army_id, bblib.TILES_BY_IDX)
-    jsondata['gameInfo']['__unitmap'] = bblib.unitmap_list(bblib.TILES_BY_IDX.values(), player_id)
-    move = bblib.select_next_move(player_id, jsondata['gameInfo'], preparsed=True)
+    # the parsed map's terrain grids are shared by every move.  tile values are all
+    # scalars, so copying each tile dict is as good as a deepcopy, and much cheaper
+    state = master_state.view(army_id, dict([(xyidx, dict(tile)) for xyidx, tile in
+                                             master_tiles_by_idx.items()]))
+    bblib.set_fog_values(state)
+    jsondata['gameInfo']['__unitmap'] = bblib.unitmap_list(state.tiles_by_idx.values(), player_id)
+    move = bblib.select_next_move(player_id, jsondata['gameInfo'], state)
     #print("move #{}: \n{}".format(movenum, bblib.compact_json_dumps(move)))
-    return move
+    return move, state
 
-def main():
-    global MASTER_TILES_BY_IDX
-    if os.environ.get('DBG_RAND_SEED', '') == '':
-        bblib.DBG_RAND_SEED = int(time.time())
-        print("randomizing random seed: {}".format(bblib.DBG_RAND_SEED))
+def run_game(board_filename=None, seed=None, max_turns=None, verbose=True):
+    """plays one game on board_filename (default BOARD_FILENAME), seeded with seed
+    (default DBG_RAND_SEED), and saves its moves (see board_move_state).  returns
+    a GameResult.  verbose=False skips the turn-by-turn printout."""
+    start_time = time.time()
+    board_filename = board_filename or BOARD_FILENAME
+    max_turns = MAX_TURNS if max_turns is None else max_turns
+    log = print if verbose else (lambda *args: None)
+    if seed is not None:
+        bblib.DBG_RAND_SEED = seed
     bblib.set_random_seed()
-    game_state = json.loads(open(BOARD_FILENAME).read())
+    game_state = load_board(board_filename)
     game_info = game_state['gameInfo']
-    bblib.parse_map(1, game_info['tiles'], game_info)
-    MASTER_TILES_BY_IDX = copy.deepcopy(bblib.TILES_BY_IDX)
-    game_info['__tilemap'] = bblib.tilemap_list(MASTER_TILES_BY_IDX.values())
+    # games in one process mustn't see each other's per-game state
+    bblib.GAMES.pop(game_info['game_id'])
+    bblib.LAST_MOVES.pop(game_info['game_id'])
+    master_state = bblib.parse_map(1, game_info['tiles'], game_info)
+    master_tiles_by_idx = copy.deepcopy(master_state.tiles_by_idx)
+    game_info['__tilemap'] = bblib.tilemap_list(master_tiles_by_idx.values())
     num_players = len(game_info['players'])
-    last_move = {}
+    board_move_states, board_move_states_json = [], []
     player_info_dict = {}
     turns = {}
     resigned = {}
@@ -51,24 +82,56 @@ def main():
     for player_info in game_info['players'].values():
         army_id = player_info['army_id']
         player_info['funds'] = 0
-        last_move[army_id] = None
         player_info_dict[int(player_info['turn_order'])] = player_info
         turns[army_id] = []
         resigned[army_id] = False
         position_scores[army_id] = 0
     player_turn_idx = 0
-    movenum = 0
     dbg_bitmaploc = None
     dbg_bitmap_printed = False
     num_state_bits = 0
+    # the dbgloc printouts come from the text encoder
+    packed = (bms.BOARD_STATE_FORMAT == 'packed' and not DBG_BITMAP)
+
+    def result(winner, reason):
+        game_result = GameResult(board_filename, bblib.DBG_RAND_SEED, winner, reason,
+                                 max(len(army_turns) for army_turns in turns.values()),
+                                 len(board_move_states), time.time() - start_time)
+        if reason == 'state_bits':
+            pass
+        elif dataset.DATASET_DIR:
+            dataset.dataset_writer().append_game(
+                game_result, board_move_states if packed else
+                [numpy.array(bitmap) == '1' for bitmap in board_move_states],
+                board_move_states_json)
+        else:
+            write_states = (bms.write_board_move_state_packed if packed
+                            else bms.write_board_move_state)
+            # states record the player turn index, not the army_id
+            write_states(-1 if winner is None else [
+                turn_order - 1 for turn_order, info in player_info_dict.items()
+                if info['army_id'] == winner][0], board_move_states)
+            bms.write_board_move_state_json(-1 if winner is None else winner,
+                                            board_move_states_json)
+        return game_result
+
+    def final_board(winner):
+        log("winner: army_id={} (capital letters)".format(winner))
+        log("final board position (no fog):")
+        tiles_list = master_tiles_by_idx.values()
+        for final_tile in tiles_list:
+            final_tile['in_fog'] = '0'
+        log(bblib.unitmap_json(tiles_list, winner))
 
     # main loop - take turn for each player
     while True:
         player_info = player_info_dict[player_turn_idx+1]
         army_id = player_info['army_id']
-        print("turn #{}, army #{}:".format(len(turns[army_id])+1, army_id))
-        if resigned[army_id]: continue
-        bblib.initialize_player_turn(army_id, MASTER_TILES_BY_IDX, player_info, game_state)
+        log("turn #{}, army #{}:".format(len(turns[army_id])+1, army_id))
+        if resigned[army_id]:
+            player_turn_idx = (player_turn_idx + 1) % num_players
+            continue
+        bblib.initialize_player_turn(army_id, master_tiles_by_idx, player_info, game_state)
         turns[army_id].append([])
         if DBG_BITMAP and not dbg_bitmap_printed and len(turns[army_id]) == 2:
             dbg_bitmaploc = 0
@@ -78,31 +141,44 @@ def main():
             if DBG_GAME_STATE:
                 print("army_id={}  player_turn_idx={}  funds={}".format(
                     army_id, player_turn_idx+1, player_info['funds']))
-            move = make_move(len(turns[army_id]), game_state)
-            bstate = bms.encode_board_state(player_turn_idx, resigned, game_info,
-                                            list(MASTER_TILES_BY_IDX.values()), dbg_bitmaploc)
+            try:
+                move, state = make_move(master_state, master_tiles_by_idx, game_state)
+            except bblib.GameOver:
+                final_board(army_id)
+                return result(army_id, 'captured')
+            if packed:
+                bstate = bms.encode_board_state_bits(player_turn_idx, resigned, game_info,
+                                                     list(master_tiles_by_idx.values()))
+            else:
+                bstate = bms.encode_board_state(player_turn_idx, resigned, game_info,
+                                                list(master_tiles_by_idx.values()), dbg_bitmaploc)
             if bstate is None:
-                print("DBG_MAX_UNITS hit: ending game without resolution -- all players are losers")
-                bms.write_board_move_state(-1, BOARD_MOVE_STATES)
-                bms.write_board_move_state_json(-1, BOARD_MOVE_STATES_JSON)
-                sys.exit(0)
+                log("DBG_MAX_UNITS hit: ending game without resolution -- all players are losers")
+                return result(None, 'max_units')
             if dbg_bitmaploc is not None:
                 dbg_bitmaploc = len(bstate)
-            mstate = bms.encode_move(move, MASTER_TILES_BY_IDX, dbg_bitmaploc)
+            if packed:
+                mstate = bms.encode_move_bits(move, master_tiles_by_idx)
+            else:
+                mstate = bms.encode_move(move, master_tiles_by_idx, dbg_bitmaploc)
             if num_state_bits == 0:
                 num_state_bits = len(bstate)+len(mstate)
             elif num_state_bits != len(bstate)+len(mstate):
                 print("*** ERROR: number of state bits changed?!?!?!? - not saving game")
-                sys.exit(0)
-            BOARD_MOVE_STATES.append(bstate + mstate)
+                return result(None, 'state_bits')
+            board_move_states.append(numpy.concatenate([bstate, mstate]) if packed
+                                     else bstate + mstate)
             #if bms.is_move_attack(move):
-            #    BOARD_ATTACKS.append(bms.encode_attack(move, MASTER_TILES_BY_IDX))
-            if True: BOARD_MOVE_STATES_JSON.append({
+            #    BOARD_ATTACKS.append(bms.encode_attack(move, master_tiles_by_idx))
+            if True: board_move_states_json.append({
                 'turn': player_turn_idx,
                 'army_id': army_id,
-                'resigned': resigned,
+                'resigned': dict(resigned),
                 'move': move,
-                'board': bblib.compressed_game_info(game_info, army_id) # internal deepcopy
+                # a snapshot: compressed_game_info fills in and returns its argument
+                'board': bblib.compressed_game_info(
+                    dict(game_info, players=copy.deepcopy(game_info['players'])),
+                    army_id, state.tiles_by_idx)
             })
             if dbg_bitmaploc is not None:
                 print("board_state={} bits: board={}, move={}".format(
@@ -110,26 +186,25 @@ def main():
                 dbg_bitmap_printed = True
                 dbg_bitmaploc = None  # disable after first execution
             turns[army_id][-1].append(move)
-            res = bblib.apply_move(army_id, MASTER_TILES_BY_IDX, player_info, move, dbg=True)
+            res = bblib.apply_move(army_id, master_tiles_by_idx, player_info, move, dbg=verbose)
             if not res:
                 break
 
-        for aid in resigned.keys():
-            owned = [tile for tile in MASTER_TILES_BY_IDX.values()
-                     if tile['building_army_id'] == aid]
-            print('army_id={} owns {} bldgs: {}'.format(aid, len(owned), " ".join([
-                bblib.tilestr(mytile, show_unit=False) for mytile in owned])))
-
-        if len(turns[army_id]) > MAX_TURNS:
-            print("MAX_TURNS hit: ending game without resolution -- all players are losers")
-            bms.write_board_move_state(-1, BOARD_MOVE_STATES)
-            bms.write_board_move_state_json(-1, BOARD_MOVE_STATES_JSON)
-            sys.exit(0)
+        if verbose:
+            for aid in resigned.keys():
+                owned = [tile for tile in master_tiles_by_idx.values()
+                         if tile['building_army_id'] == aid]
+                print('army_id={} owns {} bldgs: {}'.format(aid, len(owned), " ".join([
+                    bblib.tilestr(mytile, show_unit=False) for mytile in owned])))
+
+        if len(turns[army_id]) > max_turns:
+            log("MAX_TURNS hit: ending game without resolution -- all players are losers")
+            return result(None, 'max_turns')
             
         # resign if no moves in two turns
         if (len(turns[army_id]) > 1 and len(turns[army_id][-1]) == 1 and
             turns[army_id][-2][-1]['data']['end_turn']):
-            print("army #{} resigning: no move in two turns".format(army_id))
+            log("army #{} resigning: no move in two turns".format(army_id))
             resigned[army_id] = True
 
         # resign if post-move, we're <75% the position-score of the next-lowest
@@ -137,26 +212,28 @@ def main():
         other_pscores = dict([item for item in position_scores.items()
                               if item[0] != army_id])
         if position_scores[army_id] < RESIGN_THRES * min(other_pscores.values()):
-            print("army #{} resigning: pos_score={} vs others={}".format(
+            log("army #{} resigning: pos_score={} vs others={}".format(
                 army_id, pscore, other_pscores))
             resigned[army_id] = True
 
         # detect end of game
         if resigned[army_id] and sum(resigned.values()) == len(resigned)-1:
-            for army_id, resigned in resigned.items():
-                if not resigned:
-                    print("winner: army_id={} (capital letters)".format(army_id))
-                    print("final board position (no fog):")
-                    tiles_list = MASTER_TILES_BY_IDX.values()
-                    for final_tile in tiles_list:
-                        final_tile['in_fog'] = '0'
-                    print(bblib.unitmap_json(tiles_list, army_id))
-                    bms.write_board_move_state(army_id, BOARD_MOVE_STATES)
-                    bms.write_board_move_state_json(-1, BOARD_MOVE_STATES_JSON)
-                    sys.exit(0)
+            winner = [aid for aid, aid_resigned in resigned.items() if not aid_resigned][0]
+            final_board(winner)
+            return result(winner, 'resigned')
 
         # advance to next player
         player_turn_idx = (player_turn_idx + 1) % num_players
 
+def main():
+    if os.environ.get('DBG_RAND_SEED', '') == '':
+        bblib.DBG_RAND_SEED = int(time.time())
+        print("randomizing random seed: {}".format(bblib.DBG_RAND_SEED))
+    if os.environ.get('DBG_BOARD', '') == '':
+        bblib.DBG_BOARD = True    # show the board every turn
+    if bblib.PARALLEL_MOVE_DISCOVERY:
+        bblib.start_worker_pool()
+    run_game(BOARD_FILENAME)
+
 if __name__ == '__main__':
     main()